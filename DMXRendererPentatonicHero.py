@@ -2,8 +2,26 @@
 Plugin for use with 'lighting-automation' project
 """
 
+import os
+import json
+
 from lighting import AbstractDMXRenderer
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import display_codec  # Packed display events - only available with the pentatonic_hero modules on the path
+except ImportError:
+    display_codec = None
+
+try:
+    import state_feed  # Shared memory player state - only available with the pentatonic_hero modules on the path
+except ImportError:
+    state_feed = None
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -16,12 +34,157 @@ COLORS = {
     'orange': (255, 30, 0),
     'black': (0, 0, 0),
 }
-BUTTON_COLORS = tuple(COLORS[color] for color in ('green', 'red', 'yellow', 'blue', 'orange'))
 LIGHT_INDEX = [0, 8, 16, 24, 32, 40, 48, 56, 64]
-LIGHT_CONFIG = {
-    1: [0, 16, 8],  # floor 2 - 77, 80, 83
-    2: [40, 56, 48],  # floor 3 - 88, 91, 94
+
+# The fixture map can be replaced with a json file of the same layout named by this environment variable
+FIXTURE_MAP_ENVIRONMENT_VARIABLE = 'PENTATONIC_HERO_FIXTURE_MAP'
+DEFAULT_FIXTURE_MAP = {
+    'button_colors': ('green', 'red', 'yellow', 'blue', 'orange'),
+    # input number -> dmx offsets of the RGB fixtures showing that player's highest button
+    'players': {
+        1: [0, 16, 8],  # floor 2 - 77, 80, 83
+        2: [40, 56, 48],  # floor 3 - 88, 91, 94
+    },
+    # Optional: input number -> dmx offset of a fixture for each button (the old per button LIGHT_INDEX layout)
+    #'button_fixtures': {
+    #    1: LIGHT_INDEX[0:5],
+    #},
+    # Optional: fades and flashes computed every frame with numpy (see LightingEffects)
+    #'effects': {
+    #    'decay': 0.9,
+    #    'sustain': 0.6,
+    #    'release': 0.8,
+    #    'flash_decay': 0.7,
+    #},
+}
+DEFAULT_EFFECTS = {
+    'decay': 0.9,  # per frame - held notes fade from their hit velocity toward the sustain level
+    'sustain': 0.6,
+    'release': 0.8,  # per frame - fade to black after note off
+    'flash_decay': 0.7,  # per frame - strums flash fixtures toward white
 }
+BUTTON_COLORS = tuple(COLORS[color] for color in DEFAULT_FIXTURE_MAP['button_colors'])
+LIGHT_CONFIG = DEFAULT_FIXTURE_MAP['players']
+
+
+def load_fixture_map(filename):
+    with open(filename, 'rt') as filehandle:
+        fixture_map = json.load(filehandle)
+    for key in ('players', 'button_fixtures'):
+        if key in fixture_map:
+            fixture_map[key] = {int(input_num): offsets for input_num, offsets in fixture_map[key].items()}
+    return fixture_map
+
+
+def _button_colors(fixture_map):
+    return tuple(COLORS[color] if isinstance(color, str) else tuple(color) for color in fixture_map['button_colors'])
+
+
+class PlayerFixtures(object):
+    """
+    The fixtures of one player with the universe bytes for each button color precomputed.
+    Only rendered when the color shown needs to change.
+    """
+    BLACK = -1
+
+    def __init__(self, offsets, button_colors):
+        self.slices = tuple(slice(offset, offset + 3) for offset in offsets)
+        self.patterns = {index: bytes(color) for index, color in enumerate(button_colors)}
+        self.patterns[self.BLACK] = bytes(COLORS['black'])
+        self.buttons = set()
+        self.color_index = None  # Not yet rendered
+
+    def render(self, dmx_universe):
+        color_index = max(self.buttons) if self.buttons else self.BLACK
+        if color_index == self.color_index:
+            return
+        self.color_index = color_index
+        pattern = self.patterns[color_index]
+        for fixture_slice in self.slices:
+            dmx_universe[fixture_slice] = pattern
+
+
+class LightingEffects(object):
+    """
+    Per frame lighting computed with vectorised numpy operations over every fixture.
+
+    Each fixture has a color, an intensity and a flash level.
+    - note_on sets the intensity from the hit velocity (hammer-ons decay, so they are dimmer)
+    - held notes decay toward the sustain level, released notes decay to black
+    - strums flash a player's fixtures toward white
+    Player wide fixtures take the color of the note's button.
+    Per button fixtures only light for their own button.
+    """
+    def __init__(self, fixture_map, dmx_universe):
+        effects = dict(DEFAULT_EFFECTS, **fixture_map.get('effects', {}))
+        self.decay = effects['decay']
+        self.sustain = effects['sustain']
+        self.release = effects['release']
+        self.flash_decay = effects['flash_decay']
+
+        button_colors = _button_colors(fixture_map)
+        fixtures = []  # (offset, input_num, button)
+        for input_num, offsets in fixture_map['players'].items():
+            fixtures += [(offset, input_num, -1) for offset in offsets]
+        for input_num, offsets in fixture_map.get('button_fixtures', {}).items():
+            fixtures += [(offset, input_num, button) for button, offset in enumerate(offsets)]
+        offsets = numpy.array([fixture[0] for fixture in fixtures], dtype=numpy.intp)
+        inputs = numpy.array([fixture[1] for fixture in fixtures])
+        self.buttons = numpy.array([fixture[2] for fixture in fixtures])
+
+        self.button_colors = numpy.array(button_colors, dtype=numpy.float32)
+        self.player_masks = {input_num: inputs == input_num for input_num in set(inputs.tolist())}
+        self.wide = self.buttons == -1
+
+        self.color = numpy.zeros((len(fixtures), 3), dtype=numpy.float32)
+        self.color[~self.wide] = self.button_colors[self.buttons[~self.wide]]
+        self.intensity = numpy.zeros(len(fixtures), dtype=numpy.float32)
+        self.flash = numpy.zeros(len(fixtures), dtype=numpy.float32)
+        self.held = numpy.zeros(len(fixtures), dtype=bool)
+
+        # Universe byte index of every fixture channel - written with a single fancy index assignment
+        self.channels = (offsets[:, None] + numpy.arange(3)).ravel()
+        self.universe = dmx_universe if isinstance(dmx_universe, numpy.ndarray) else numpy.frombuffer(dmx_universe, dtype=numpy.uint8)
+
+    def note_on(self, input_num, button, velocity=1.0):
+        player = self.player_masks.get(input_num)
+        if player is None or button is None:
+            return
+        wide = player & self.wide
+        own = player & (self.wide | (self.buttons == button))
+        self.color[wide] = self.button_colors[button]
+        self.held[player] = False
+        self.held[own] = True
+        self.intensity[own] = velocity
+
+    def note_off(self, input_num):
+        player = self.player_masks.get(input_num)
+        if player is not None:
+            self.held[player] = False
+
+    def strum(self, input_num):
+        player = self.player_masks.get(input_num)
+        if player is not None:
+            self.flash[player] = 1
+
+    def render(self):
+        self.intensity[:] = numpy.where(
+            self.held,
+            self.sustain + (self.intensity - self.sustain) * self.decay,
+            self.intensity * self.release,
+        )
+        self.flash *= self.flash_decay
+        lit = self.color * self.intensity[:, None]
+        lit += (255 - lit) * self.flash[:, None]
+        self.universe[self.channels] = lit.astype(numpy.uint8).ravel()
+
+    def event(self, event, data):
+        if event == 'note_on':
+            self.note_on(data.get('input'), data.get('button'), data.get('velocity', 1.0))
+        elif event == 'note_off':
+            self.note_off(data.get('input'))
+        elif event == 'strum':
+            self.strum(data.get('input'))
 
 
 class DMXRendererPentatonicHero(AbstractDMXRenderer):
@@ -29,40 +192,99 @@ class DMXRendererPentatonicHero(AbstractDMXRenderer):
 
     @staticmethod
     def set_color(dmx_universe, offset, color):
-        for index, value in enumerate(color):
-            dmx_universe[offset + index] = value
+        dmx_universe[offset:offset + len(color)] = bytes(color)
 
     @staticmethod
     def set_player_color(dmx_universe, input_num, color):
         for index in LIGHT_CONFIG[input_num]:
             DMXRendererPentatonicHero.set_color(dmx_universe, index, color)
 
-    def __init__(self):
+    def __init__(self, fixture_map=None):
         super().__init__()
-        self.player_state = {1: set(), 2: set()}
+        if fixture_map is None:
+            fixture_map = load_fixture_map(os.environ[FIXTURE_MAP_ENVIRONMENT_VARIABLE]) if os.environ.get(FIXTURE_MAP_ENVIRONMENT_VARIABLE) else DEFAULT_FIXTURE_MAP
+        button_colors = _button_colors(fixture_map)
+        self.players = {
+            input_num: PlayerFixtures(offsets, button_colors)
+            for input_num, offsets in fixture_map['players'].items()
+        }
+        self.player_state = {input_num: fixtures.buttons for input_num, fixtures in self.players.items()}
+        self.dirty = set(self.players.values())
+
+        # Button state read from the pentatonic_hero --state_feed every frame instead of button events
+        self.state_feed = None
+        self.fed_inputs = frozenset()  # Inputs in the feed - the others (e.g. input shard players) still use button events
+        state_feed_filename = os.environ.get(state_feed.STATE_FEED_ENVIRONMENT_VARIABLE) if state_feed else None
+        if state_feed_filename:
+            try:
+                self.state_feed = state_feed.StateFeedReader(state_feed_filename)
+            except (OSError, ValueError, AssertionError) as ex:
+                log.warning('unable to read state feed {0}: {1} - using button events'.format(state_feed_filename, ex))
+        self.button_masks = {}
+        self.packed_warned = False
+
+        self.effects = None
+        if 'effects' in fixture_map:
+            if numpy:
+                self.effects = LightingEffects(fixture_map, self.dmx_universe)
+            else:
+                log.warning('numpy is not installed - lighting effects disabled')
+
+    def read_state_feed(self):
+        states = self.state_feed.read()
+        if not states:
+            return
+        self.fed_inputs = frozenset(state.input for state in states if state.input)
+        for state in states:
+            fixtures = self.players.get(state.input)
+            if not fixtures or self.button_masks.get(state.input) == state.button_mask:
+                continue
+            self.button_masks[state.input] = state.button_mask
+            fixtures.buttons.clear()
+            fixtures.buttons.update(button for button in range(len(fixtures.patterns) - 1) if state.button_mask & (1 << button))
+            self.dirty.add(fixtures)
 
     def render(self, frame):
-        for input_num in (1, 2):
-            for button_num in range(5):
-                if not self.player_state[input_num]:
-                    self.set_player_color(self.dmx_universe, input_num, COLORS['black'])
-                elif button_num in self.player_state[input_num]:
-                    self.set_player_color(self.dmx_universe, input_num, BUTTON_COLORS[button_num])
-                # Reference for old logic that activated differnt lights for each button
-                #if button_num in self.player_state[input_num]:
-                #    self.set_color(self.dmx_universe, LIGHT_INDEX[button_num], BUTTON_COLORS[button_num])
-                #else:
-                #    self.set_color(self.dmx_universe, LIGHT_INDEX[button_num], COLORS['black'])
+        if self.state_feed:
+            self.read_state_feed()
+        if self.effects:
+            self.effects.render()
+        elif self.dirty:
+            dirty, self.dirty = self.dirty, set()
+            for fixtures in dirty:
+                fixtures.render(self.dmx_universe)
+        # Reference for old logic that activated differnt lights for each button
+        #if button_num in self.player_state[input_num]:
+        #    self.set_color(self.dmx_universe, LIGHT_INDEX[button_num], BUTTON_COLORS[button_num])
+        #else:
+        #    self.set_color(self.dmx_universe, LIGHT_INDEX[button_num], COLORS['black'])
         return self.dmx_universe
 
     def event(self, data):
         """
         Update the stored button state
         """
-        button_set = self.player_state[data['input']]
+        if isinstance(data, list):
+            for item in data:
+                self.event(item)
+            return
         event = data.get('event')
+        if event == 'packed':
+            if display_codec:
+                self.event(display_codec.unpack(data['data']))
+            elif not self.packed_warned:
+                self.packed_warned = True
+                log.warning('packed display events require display_codec - run pentatonic_hero with --display_format json')
+            return
         button = data.get('button')
+        if self.effects:
+            self.effects.event(event, data)
+        fixtures = self.players.get(data.get('input'))
+        if not fixtures or data.get('input') in self.fed_inputs:
+            return
         if event == 'button_up':
-            button_set.discard(button)
+            fixtures.buttons.discard(button)
+            self.dirty.add(fixtures)
         if event == 'button_down':
-            button_set.add(button)
+            fixtures.buttons.add(button)
+            self.dirty.add(fixtures)
@@ -0,0 +1,86 @@
+""" Pentatonic Hero - asyncio App runtime
+
+Runs an App on a single asyncio event loop:
+
+    input    - polls pygame events, processes them and runs due timers
+    display  - drains the display queue; blocking socket sends happen in a single
+               worker thread that never touches HeroInput state
+    commands - display control commands (mute) received on the SubscriptionClient
+               thread are handed to the loop with call_soon_threadsafe
+
+All HeroInput state is only ever touched from the loop.
+"""
+
+# Imports ----------------------------------------------------------------------
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_POLL_INTERVAL = 1  # ms
+
+
+# Runtime ----------------------------------------------------------------------
+
+class AsyncRuntime(object):
+    def __init__(self, app, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.app = app
+        self.poll_interval = poll_interval / 1000
+        self.display_wake = None
+        self.display_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='display_send')
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            self.app.running = False
+        self.display_executor.shutdown()
+        self.app.close()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        app = self.app
+        app.running = True
+
+        # Control commands arrive on the SubscriptionClient's thread - hand them to the loop
+        app.display.recive_message = lambda data: loop.call_soon_threadsafe(app.control_command, data)
+
+        self.display_wake = asyncio.Event()
+        if app.display_queue:
+            app.display_queue.notify = self.display_wake.set
+
+        display_task = asyncio.ensure_future(self.display())
+        try:
+            await self.input()
+        finally:
+            display_task.cancel()
+
+    async def input(self):
+        app = self.app
+        scheduler = app.scheduler
+        while app.running:
+            app.run_timers()
+            for event in pygame.event.get():
+                app.process_event(event)
+                if not app.running:
+                    return
+            timeout = scheduler.timeout_ms()
+            await asyncio.sleep(self.poll_interval if timeout is None else min(self.poll_interval, timeout / 1000))
+
+    async def display(self):
+        queue = self.app.display_queue
+        if not queue:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.display_wake.wait()
+            self.display_wake.clear()
+            batch = queue.take_batch()
+            while batch:
+                await loop.run_in_executor(self.display_executor, queue.send_batch, batch)
+                batch = queue.take_batch()
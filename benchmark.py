@@ -0,0 +1,291 @@
+""" Pentatonic Hero - Headless benchmark of the controls -> HeroInput -> midi hot path
+
+Feeds synthetic pygame events through each controls profile and a HeroInput
+into stub midi/display outputs. No display, joystick or midi device is required.
+
+    python3 benchmark.py
+    python3 benchmark.py --profile ps3_joy1 --scenario pitch_bend_sweep --events 100000
+"""
+
+# Imports ----------------------------------------------------------------------
+import time
+import random
+import tracemalloc
+from array import array
+
+import pygame
+
+import controls
+from pentatonic_hero import HeroInput
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_EVENTS = 20000
+DEFAULT_SEED = 0
+
+PS3_TOUCH_PAD_AXIS = 3  # Spams axis events whenever the touch pad is brushed
+
+
+def _profile_inputs(definition):
+    """
+    The raw inputs of a controls profile definition the synthetic scenarios need to drive
+    """
+    inputs = {}
+    if 'keys' in definition:
+        inputs['note_keys'] = tuple(controls.key_code(key) for key in definition['keys']['notes'])
+        inputs['strum_key'] = controls.key_code(definition['keys']['strum'])
+    if 'joy' in definition:
+        inputs['joy'] = definition['joy']
+        inputs['note_buttons'] = tuple(definition['buttons']['notes'])
+    for (source, name, input_name) in (
+        ('hats', 'strum', 'strum_hat'),
+        ('axes', 'strum', 'strum_axis'),
+        ('axes', 'pitch_bend', 'pitch_axis'),
+    ):
+        if name in definition.get(source, {}):
+            inputs[input_name] = definition[source][name]
+    if 'pitch_axis' in inputs:
+        inputs['spam_axis'] = PS3_TOUCH_PAD_AXIS
+    return inputs
+
+
+PROFILE_INPUTS = {name: _profile_inputs(controls.PROFILES[name]) for name in controls.__all__}
+
+
+# Stubs ------------------------------------------------------------------------
+
+class StubMidiOutput(object):
+    """
+    Stands in for PygameMidiOutputWrapper
+    """
+    def __init__(self):
+        self.notes = 0
+        self.pitches = 0
+
+    def note(self, note, velocity=1.0):
+        self.notes += 1
+
+    def pitch(self, pitch):
+        self.pitches += 1
+
+
+class StubDisplay(object):
+    """
+    Stands in for SubscriptionClient
+    """
+    def __init__(self):
+        self.messages = 0
+
+    def send_message(self, data):
+        self.messages += 1
+
+    def close(self):
+        pass
+
+
+# Synthetic Events -------------------------------------------------------------
+
+class SyntheticInput(object):
+    """
+    Build pygame events for a profile's raw inputs
+    """
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+    def note(self, index, down):
+        if 'note_keys' in self.inputs:
+            return pygame.event.Event(pygame.KEYDOWN if down else pygame.KEYUP, key=self.inputs['note_keys'][index])
+        return pygame.event.Event(pygame.JOYBUTTONDOWN if down else pygame.JOYBUTTONUP, joy=self.inputs['joy'], button=self.inputs['note_buttons'][index])
+
+    def strum(self, direction=1):
+        if 'strum_key' in self.inputs:
+            return pygame.event.Event(pygame.KEYDOWN, key=self.inputs['strum_key'])
+        if 'strum_hat' in self.inputs:
+            return pygame.event.Event(pygame.JOYHATMOTION, joy=self.inputs['joy'], hat=self.inputs['strum_hat'], value=(0, direction))
+        return pygame.event.Event(pygame.JOYAXISMOTION, joy=self.inputs['joy'], axis=self.inputs['strum_axis'], value=float(direction))
+
+    def axis(self, axis, value):
+        return pygame.event.Event(pygame.JOYAXISMOTION, joy=self.inputs['joy'], axis=axis, value=value)
+
+
+def scenario_button_mashing(synthetic, rand):
+    while True:
+        index = rand.randrange(HeroInput.NUMBER_OF_BUTTONS)
+        yield synthetic.note(index, True)
+        yield synthetic.strum(rand.choice((1, -1)))
+        yield synthetic.note(index, False)
+
+
+def scenario_hammer_on_runs(synthetic, rand):
+    yield synthetic.note(0, True)
+    yield synthetic.strum()
+    while True:
+        for index in range(1, HeroInput.NUMBER_OF_BUTTONS):
+            yield synthetic.note(index, True)
+        for index in reversed(range(1, HeroInput.NUMBER_OF_BUTTONS)):
+            yield synthetic.note(index, False)
+        yield synthetic.strum()
+
+
+def scenario_pitch_bend_sweep(synthetic, rand):
+    axis = synthetic.inputs['pitch_axis']
+    yield synthetic.note(2, True)
+    yield synthetic.strum()
+    steps = 256
+    while True:
+        for step in range(-steps, steps + 1):
+            yield synthetic.axis(axis, step / steps)
+
+
+def scenario_touchpad_axis_spam(synthetic, rand):
+    axis = synthetic.inputs['spam_axis']
+    while True:
+        yield synthetic.axis(axis, rand.uniform(-1, 1))
+
+
+SCENARIOS = {
+    'button_mashing': (scenario_button_mashing, ()),
+    'hammer_on_runs': (scenario_hammer_on_runs, ()),
+    'pitch_bend_sweep': (scenario_pitch_bend_sweep, ('pitch_axis', )),
+    'touchpad_axis_spam': (scenario_touchpad_axis_spam, ('spam_axis', )),
+}
+
+
+def generate_events(profile_name, scenario_name, number_of_events, seed=DEFAULT_SEED):
+    inputs = PROFILE_INPUTS[profile_name]
+    scenario, required_inputs = SCENARIOS[scenario_name]
+    if not all(required in inputs for required in required_inputs):
+        return None
+    events = scenario(SyntheticInput(inputs), random.Random(seed))
+    return [next(events) for _ in range(number_of_events)]
+
+
+# Benchmark --------------------------------------------------------------------
+
+def _hero_input(profile_name):
+    midi_output = StubMidiOutput()
+    display = StubDisplay()
+    return HeroInput(controls.load_profile(profile_name), midi_output, display=display), midi_output, display
+
+
+def _noop(*args):
+    pass
+
+
+def _traced_allocations(events, update_state, process_state):
+    """
+    Sum of the peak memory allocated while processing each event
+    """
+    allocated_bytes = 0
+    tracemalloc.start()
+    for event in events:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        update_state(event)
+        process_state()
+        allocated_bytes += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return allocated_bytes
+
+
+def _percentile(sorted_samples, percent):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percent / 100))]
+
+
+def benchmark(profile_name, scenario_name, number_of_events=DEFAULT_EVENTS, seed=DEFAULT_SEED):
+    """
+    Run one profile/scenario and return a dict of results.
+    Three passes are made over the same events: untimed throughput,
+    per event latency, and per event peak allocation with tracemalloc.
+    """
+    events = generate_events(profile_name, scenario_name, number_of_events, seed)
+    if events is None:
+        return None
+
+    # Throughput
+    hero_input, midi_output, display = _hero_input(profile_name)
+    update_state = hero_input.update_state
+    process_state = hero_input.process_state
+    start = time.perf_counter()
+    for event in events:
+        update_state(event)
+        process_state()
+    duration = time.perf_counter() - start
+
+    # Latency
+    hero_input, _, _ = _hero_input(profile_name)
+    update_state = hero_input.update_state
+    process_state = hero_input.process_state
+    clock = time.perf_counter_ns
+    samples = array('q', [0]) * len(events)
+    for index, event in enumerate(events):
+        timestamp = clock()
+        update_state(event)
+        process_state()
+        samples[index] = clock() - timestamp
+    samples = sorted(samples)
+
+    # Allocations (less the measuring overhead of the loop itself)
+    hero_input, _, _ = _hero_input(profile_name)
+    allocated_bytes = _traced_allocations(events, hero_input.update_state, hero_input.process_state) - \
+                      _traced_allocations(events, _noop, _noop)
+
+    return {
+        'profile': profile_name,
+        'scenario': scenario_name,
+        'events': len(events),
+        'events_per_second': int(len(events) / duration),
+        'p50_us': _percentile(samples, 50) / 1000,
+        'p99_us': _percentile(samples, 99) / 1000,
+        'max_us': samples[-1] / 1000,
+        'alloc_bytes_per_event': max(0, allocated_bytes) / len(events),
+        'midi_messages': midi_output.notes + midi_output.pitches,
+        'display_messages': display.messages,
+    }
+
+
+def run(profile_names, scenario_names, number_of_events=DEFAULT_EVENTS, seed=DEFAULT_SEED):
+    for profile_name in profile_names:
+        for scenario_name in scenario_names:
+            result = benchmark(profile_name, scenario_name, number_of_events, seed)
+            if result:
+                yield result
+
+
+# Main -------------------------------------------------------------------------
+
+RESULT_FORMAT = '{profile:<10} {scenario:<20} {events_per_second:>10} {p50_us:>8.2f} {p99_us:>8.2f} {max_us:>9.2f} {alloc_bytes_per_event:>9.1f} {midi_messages:>7} {display_messages:>8}'
+HEADER_FORMAT = '{0:<10} {1:<20} {2:>10} {3:>8} {4:>8} {5:>9} {6:>9} {7:>7} {8:>8}'
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description="""Pentatonic Hero benchmark -
+        Measure the controls -> HeroInput -> midi hot path without any devices
+        """,
+    )
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILE_INPUTS.keys()), help='controls profile to benchmark (default all)')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS.keys()), help='synthetic input scenario (default all)')
+    parser.add_argument('--events', action='store', type=int, help='number of events per run', default=DEFAULT_EVENTS)
+    parser.add_argument('--seed', action='store', type=int, help='random seed for synthetic input', default=DEFAULT_SEED)
+    parser.add_argument('--json', action='store_true', help='output results as json lines')
+
+    args = parser.parse_args()
+    args.profile = args.profile or sorted(PROFILE_INPUTS.keys())
+    args.scenario = args.scenario or sorted(SCENARIOS.keys())
+    return args
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.json:
+        import json
+        for result in run(args.profile, args.scenario, args.events, args.seed):
+            print(json.dumps(result))
+    else:
+        print(HEADER_FORMAT.format('profile', 'scenario', 'events/s', 'p50us', 'p99us', 'max_us', 'alloc_B', 'midi', 'display'))
+        for result in run(args.profile, args.scenario, args.events, args.seed):
+            print(RESULT_FORMAT.format(**result))
@@ -1,122 +1,326 @@
-""" Pentatonic Hero - Control definitons """
+""" Pentatonic Hero - Control definitons
+
+Input profiles are declared as plain data in PROFILES (or a json file with the same layout)
+and compiled into a lookup table of (event.type, joy, button/axis/hat/key) -> handler.
+Processing an event is a single dict lookup.
+
+    'my_joy': {
+        'joy': 0,                      # joystick number (omit for keyboard profiles)
+        'buttons': {                   # joystick buttons
+            'notes': (1, 2, 0, 3, 4),  # the five note buttons from lowest to highest
+            'transpose_increment': 8,
+            'transpose_decrement': 9,
+        },
+        'hats': {'strum': 0},          # strum with a hat up/down
+        'axes': {'pitch_bend': 2},     # strum or pitch_bend with an axis
+        'invert_pitch_bend': True,
+        'drop_axes': (3, ),            # axes rejected before they reach the players (see InputFilter)
+        'strum_hysteresis': (0.5, 0.2),  # axis strum press and release thresholds
+    }
+
+Keyboard profiles use 'keys' with pygame key names (e.g. 'q', 'SPACE') in place of 'buttons'.
+"""
 
 # Imports ----------------------------------------------------------------------
+import json
+import argparse
+
 import pygame
 
 __all__ = ('keyboard', 'ps3_joy1', 'ps3_joy2', 'ps2_joy1', 'ps2_joy2')
 
+# Input event processors return True when the event was consumed by this input
 null_input = lambda event, control_methods: None
+null_input.sources = frozenset()
+null_input.joysticks = frozenset()
+
+# The event attribute that identifies the physical button/axis/hat/key for each event type
+EVENT_INPUT_ATTRIBUTE = {
+    pygame.KEYDOWN: 'key',
+    pygame.KEYUP: 'key',
+    pygame.JOYBUTTONDOWN: 'button',
+    pygame.JOYBUTTONUP: 'button',
+    pygame.JOYAXISMOTION: 'axis',
+    pygame.JOYHATMOTION: 'hat',
+}
+
+AXIS_STRUM_THRESHOLD = 0.1
+AXIS_STRUM_HYSTERESIS = (0.5, 0.2)  # An axis strum fires past the press threshold and re-arms back inside the release threshold
+
+KEYBOARD = 'keyboard'  # Input source for keyboard events (joystick events are sourced by their joy number)
+
+
+# Profiles ---------------------------------------------------------------------
+
+PROFILES = {
+    'keyboard': {
+        'keys': {
+            'notes': ('q', 'w', 'e', 'r', 't'),
+            'strum': 'SPACE',
+            'transpose_increment': 'p',
+            'transpose_decrement': 'o',
+        },
+    },
+    'ps3_joy1': {
+        'joy': 0,
+        'buttons': {
+            'notes': (1, 2, 0, 3, 4),
+            'transpose_increment': 8,
+            'transpose_decrement': 9,
+        },
+        'hats': {'strum': 0},
+        'axes': {'pitch_bend': 2},
+        'invert_pitch_bend': True,
+        'drop_axes': (3, ),  # The touch sensitive pad constantly spams axis events
+    },
+    'ps2_joy1': {
+        'joy': 0,
+        'buttons': {
+            'notes': (5, 1, 0, 2, 3),
+            'transpose_increment': 9,
+            'transpose_decrement': 8,
+        },
+        'axes': {'strum': 3},
+    },
+    'ps2_joy2': {
+        'joy': 0,
+        'buttons': {
+            'notes': (17, 13, 12, 14, 15),
+            'transpose_increment': 21,
+            'transpose_decrement': 20,
+        },
+        'axes': {'strum': 7},
+    },
+}
+PROFILES['ps3_joy2'] = dict(PROFILES['ps3_joy1'], joy=1)
+
+
+# Handlers ---------------------------------------------------------------------
+
+def _control(method_name, *args):
+    def handler(event, control_methods):
+        control_methods[method_name](*args)
+        return True
+    return handler
+
+
+def _hat_strum(event, control_methods):
+    if event.value[1] == 1 or event.value[1] == -1:
+        control_methods['strum']()
+        return True
+
+
+def _axis_strum(event, control_methods):
+    if event.value > AXIS_STRUM_THRESHOLD or event.value < -AXIS_STRUM_THRESHOLD:
+        control_methods['strum']()
+        return True
+
+
+def _axis_pitch_bend(invert):
+    def handler(event, control_methods):
+        value = -event.value if invert else event.value
+        if value > 1:
+            value = -1  # Fix for corrupt values
+        control_methods['pitch_bend'](value)
+        return True
+    return handler
+
+
+# Compile ----------------------------------------------------------------------
+
+PROFILE_KEYS = frozenset(('joy', 'buttons', 'keys', 'hats', 'axes', 'invert_pitch_bend', 'drop_axes', 'strum_hysteresis'))
+SECTION_KEYS = {
+    'buttons': frozenset(('notes', 'strum', 'transpose_increment', 'transpose_decrement')),
+    'keys': frozenset(('notes', 'strum', 'transpose_increment', 'transpose_decrement')),
+    'hats': frozenset(('strum', )),
+    'axes': frozenset(('strum', 'pitch_bend')),
+}
+
+
+def key_code(key):
+    if isinstance(key, int):
+        return key
+    code = getattr(pygame, 'K_{0}'.format(key), None)
+    if code is None:
+        raise ValueError('unknown key name {0!r}'.format(key))
+    return code
+
+
+def _unknown_keys(mapping, known, section=None):
+    unknown = sorted(set(mapping) - known)
+    if unknown:
+        raise ValueError('unknown {0} {1} (expected {2})'.format(
+            '{0} entries'.format(section) if section else 'sections',
+            ', '.join(map(repr, unknown)),
+            ', '.join(sorted(known)),
+        ))
+
+
+def compile_profile(definition, name='profile'):
+    """
+    Build the (event.type, joy, button/axis/hat/key) -> handler lookup for a profile definition.
+    An invalid definition raises argparse.ArgumentTypeError naming the problem.
+
+    >>> compile_profile({'joy': 0, 'butons': {'notes': (1, 2, 0, 3, 4)}}, 'guitar.json')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: input profile guitar.json: unknown sections 'butons' (expected axes, buttons, drop_axes, hats, invert_pitch_bend, joy, keys, strum_hysteresis)
+    >>> compile_profile({'keys': {'notes': ('q', 'NOPE')}}, 'keys.json')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: input profile keys.json: unknown key name 'NOPE'
+    """
+    try:
+        return _compile_profile(definition)
+    except (ValueError, AttributeError, KeyError, TypeError) as ex:
+        raise argparse.ArgumentTypeError('input profile {0}: {1}'.format(name, ex))
+
+
+def _compile_profile(definition):
+    if not isinstance(definition, dict):
+        raise TypeError('a profile is a json object, not {0}'.format(type(definition).__name__))
+    _unknown_keys(definition, PROFILE_KEYS)
+    for section, known in SECTION_KEYS.items():
+        _unknown_keys(definition.get(section, {}), known, section)
+    joy = definition.get('joy')
+    lookup = {}
+
+    def add(event_type, code, handler):
+        lookup[(event_type, joy, code)] = handler
+
+    for (source, down_type, up_type, to_code) in (
+        ('buttons', pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP, int),
+        ('keys', pygame.KEYDOWN, pygame.KEYUP, key_code),
+    ):
+        inputs = definition.get(source, {})
+        for index, code in enumerate(inputs.get('notes', ())):
+            add(down_type, to_code(code), _control('note_down', index))
+            add(up_type, to_code(code), _control('note_up', index))
+        for method_name in ('strum', 'transpose_increment', 'transpose_decrement'):
+            if method_name in inputs:
+                add(down_type, to_code(inputs[method_name]), _control(method_name))
+
+    hats = definition.get('hats', {})
+    if 'strum' in hats:
+        add(pygame.JOYHATMOTION, hats['strum'], _hat_strum)
+
+    axes = definition.get('axes', {})
+    if 'strum' in axes:
+        add(pygame.JOYAXISMOTION, axes['strum'], _axis_strum)
+    if 'pitch_bend' in axes:
+        add(pygame.JOYAXISMOTION, axes['pitch_bend'], _axis_pitch_bend(definition.get('invert_pitch_bend', False)))
+
+    return lookup
+
+
+class InputProfile(object):
+    """
+    A compiled input profile.
+    Called with (event, control_methods) as an input_event_processor for HeroInput.
+    """
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        self.lookup = compile_profile(definition, name)
+        self.joysticks = frozenset((definition['joy'], )) if 'joy' in definition else frozenset()
+        self.sources = self.joysticks | (frozenset((KEYBOARD, )) if 'keys' in definition else frozenset())
+
+    def __call__(self, event, control_methods):
+        handler = self.lookup.get((event.type, getattr(event, 'joy', None), getattr(event, EVENT_INPUT_ATTRIBUTE.get(event.type, 'type'), None)))
+        if handler:
+            return handler(event, control_methods)
+
+    def __repr__(self):
+        return '<InputProfile {0}>'.format(self.name)
+
+
+class InputFilter(object):
+    """
+    Rejects joystick axis events before they are routed to the players:
+    - axes a profile lists in 'drop_axes' (e.g. the PS3 touch pad)
+    - axis strum motion that is not a strum edge. A strum passes when the axis moves past the
+      press threshold (or reverses direction) and re-arms once it is back inside the release threshold.
+
+    Returns True for events to keep. Rejected events are counted in filtered.
+
+    >>> input_filter = InputFilter([InputProfile('test', {'joy': 0, 'axes': {'strum': 3}, 'drop_axes': (4, )})])
+    >>> motion = lambda axis, value: pygame.event.Event(pygame.JOYAXISMOTION, joy=0, axis=axis, value=value)
+    >>> [input_filter(motion(3, value)) for value in (0.3, 0.6, 0.9, 0.4, 0.1, -0.7, -1.0, 1.0)]
+    [False, True, False, False, False, True, False, True]
+    >>> input_filter(motion(4, 0.5))
+    False
+    >>> input_filter.filtered
+    {'drop_axes': 1, 'axis_strum': 5}
+    """
+    DROP = None
+
+    def __init__(self, input_profiles, drop_axes=()):
+        """
+        drop_axes are additional (joy, axis) pairs to reject
+        """
+        self.axes = {}  # (joy, axis) -> DROP or axis strum state [press, release, direction held]
+        for input_profile in input_profiles:
+            definition = getattr(input_profile, 'definition', {})
+            joy = definition.get('joy')
+            for axis in definition.get('drop_axes', ()):
+                self.axes[(joy, axis)] = self.DROP
+            if 'strum' in definition.get('axes', {}):
+                press, release = definition.get('strum_hysteresis', AXIS_STRUM_HYSTERESIS)
+                self.axes[(joy, definition['axes']['strum'])] = [press, release, 0]
+        for joy, axis in drop_axes:
+            self.axes[(joy, axis)] = self.DROP
+        self.filtered = {'drop_axes': 0, 'axis_strum': 0}
+
+    def __call__(self, event):
+        if event.type != pygame.JOYAXISMOTION:
+            return True
+        key = (event.joy, event.axis)
+        if key not in self.axes:
+            return True
+        strum = self.axes[key]
+        if strum is self.DROP:
+            self.filtered['drop_axes'] += 1
+            return False
+        press, release, held = strum
+        value = event.value
+        direction = 1 if value >= press else -1 if value <= -press else 0
+        if direction and direction != held:
+            strum[2] = direction
+            return True
+        if -release < value < release:
+            strum[2] = 0
+        self.filtered['axis_strum'] += 1
+        return False
+
+    @property
+    def total(self):
+        return sum(self.filtered.values())
+
+
+def event_source(event):
+    """
+    The joy number or KEYBOARD an event came from (None for anything else)
+    """
+    joy = getattr(event, 'joy', None)
+    if joy is not None:
+        return joy
+    if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+        return KEYBOARD
+    return None
+
+
+def load_profile(name):
+    """
+    Load a built in profile by name or a json profile definition from a file path
+    """
+    if name in PROFILES:
+        return InputProfile(name, PROFILES[name])
+    with open(name, 'rt') as filehandle:
+        return InputProfile(name, json.load(filehandle))
 
 
-def _ps3_joy(joystick_number):
-    button_lookup = {button: index for index, button in enumerate((1, 2, 0, 3, 4))}
-    transpose_increment = 8
-    transpose_decrement = 9
-    pitch_bend_axis = 2
-
-    def input_event_processor(event, control_methods):
-        if getattr(event, 'joy', None) != joystick_number:
-            return
-        # Buttons
-        if event.type == pygame.JOYBUTTONDOWN and event.button in button_lookup:
-            control_methods['note_down'](button_lookup[event.button])
-            return
-        if event.type == pygame.JOYBUTTONUP and event.button in button_lookup:
-            control_methods['note_up'](button_lookup[event.button])
-            return
-        # Strum
-        if event.type == pygame.JOYHATMOTION:
-            if event.value[1] == 1 or event.value[1] == -1:
-                control_methods['strum']()
-                return
-        # Transpose
-        if event.type == pygame.JOYBUTTONDOWN and event.button == transpose_increment:
-            control_methods['transpose_increment']()
-            return
-        if event.type == pygame.JOYBUTTONDOWN and event.button == transpose_decrement:
-            control_methods['transpose_decrement']()
-            return
-        # Pitch
-        if event.type == pygame.JOYAXISMOTION and event.axis == pitch_bend_axis:
-            value = -event.value
-            if value > 1:
-                value = -1  # Fix for corrupt values
-            control_methods['pitch_bend'](value)
-            return
-    return input_event_processor
-
-ps3_joy1 = _ps3_joy(0)
-ps3_joy2 = _ps3_joy(1)
-
-
-_key_lookup = {button: index for index, button in enumerate((
-    pygame.K_q,
-    pygame.K_w,
-    pygame.K_e,
-    pygame.K_r,
-    pygame.K_t,
-))}
-
-
-def keyboard(event, control_methods):
-    if event.type == pygame.KEYDOWN:
-        if event.key in _key_lookup:
-            control_methods['note_down'](_key_lookup[event.key])
-            return
-        if event.key == pygame.K_SPACE:
-            control_methods['strum']()
-            return
-        if event.key == pygame.K_p:
-            control_methods['transpose_increment']()
-            return
-        if event.key == pygame.K_o:
-            control_methods['transpose_decrement']()
-            return
-    if event.type == pygame.KEYUP:
-        if event.key in _key_lookup:
-            control_methods['note_up'](_key_lookup[event.key])
-            return
-
-
-def _ps2_joy(joystick_number, axis_strum, button_notes, transpose_increment, transpose_decrement):
-    button_lookup = {button: index for index, button in enumerate(button_notes)}
-
-    def input_event_processor(event, control_methods):
-        if getattr(event, 'joy', None) != joystick_number:
-            return
-        # Buttons
-        if event.type == pygame.JOYBUTTONDOWN and event.button in button_lookup:
-            control_methods['note_down'](button_lookup[event.button])
-            return
-        if event.type == pygame.JOYBUTTONUP and event.button in button_lookup:
-            control_methods['note_up'](button_lookup[event.button])
-            return
-        # Strum
-        if event.type == pygame.JOYAXISMOTION:
-            if event.value > 0.1 or event.value < -0.1:
-                control_methods['strum']()
-                return
-        # Transpose
-        if event.type == pygame.JOYBUTTONDOWN and event.button == transpose_increment:
-            control_methods['transpose_increment']()
-            return
-        if event.type == pygame.JOYBUTTONDOWN and event.button == transpose_decrement:
-            control_methods['transpose_decrement']()
-            return
-
-    return input_event_processor
-
-ps2_joy1 = _ps2_joy(
-    joystick_number=0,
-    axis_strum=3,
-    button_notes=(5, 1, 0, 2, 3),
-    transpose_increment=9,
-    transpose_decrement=8,
-)
-ps2_joy2 = _ps2_joy(
-    joystick_number=0,
-    axis_strum=7,
-    button_notes=(17, 13, 12, 14, 15),
-    transpose_increment=21,
-    transpose_decrement=20,
-)
+keyboard = load_profile('keyboard')
+ps3_joy1 = load_profile('ps3_joy1')
+ps3_joy2 = load_profile('ps3_joy2')
+ps2_joy1 = load_profile('ps2_joy1')
+ps2_joy2 = load_profile('ps2_joy2')
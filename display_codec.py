@@ -0,0 +1,235 @@
+""" Pentatonic Hero - Compact packed display event encoding
+
+Display events are normally sent as one json dict each with repeated string keys.
+When packing is enabled HeroInput emits records (small lists) instead, and the
+records in each batch are packed into fixed width binary records carried base64
+encoded in a single message:
+
+    {'func': 'pentatonic_hero.event', 'event': 'packed', 'data': '<base64>'}
+
+    header  <BHQ  version, record count, timestamp (ms) of the first record
+    record  <BBHBhB  opcode, input, ms since the previous record, button, value, velocity
+
+Displays that do not understand 'packed' events ignore them, so packing is only
+sent to everyone with --display_format packed. With auto, json is sent unless
+the display hub is in use, where each client that asks for packed events
+(see FORMAT_FUNCTION_NAME) gets them and every other client still gets json.
+Events without an opcode (e.g. transpose) are always sent as json.
+
+>>> records = [
+...     record('note_on', 1, 5000000, button=2, value=57, velocity=1.0),
+...     record('pitch', 1, 7000000, pitch=-1.0),
+...     record('note_off', 1, 9000000, value=57),
+... ]
+>>> message = pack(records)
+>>> message['event']
+'packed'
+>>> for event in unpack(message['data']):
+...     print(sorted(event.items()))
+[('button', 2), ('event', 'note_on'), ('input', 1), ('timestamp', 5), ('value', 57), ('velocity', 1.0)]
+[('event', 'pitch'), ('input', 1), ('pitch', -1.0), ('timestamp', 7)]
+[('event', 'note_off'), ('input', 1), ('timestamp', 9), ('value', 57)]
+"""
+
+# Imports ----------------------------------------------------------------------
+import struct
+import base64
+
+# Constants --------------------------------------------------------------------
+
+VERSION = 1
+HEADER = struct.Struct('<BHQ')
+RECORD = struct.Struct('<BBHBhB')
+MAX_INPUT = 0xFF  # input is a byte in records (and in the input shard rings)
+
+EVENT_DISPLAY_FUNCTION_NAME = 'pentatonic_hero.event'
+EVENT_PACKED = 'packed'
+# Displays send {'func': FORMAT_FUNCTION_NAME, 'formats': [...]} to say which formats they can read
+FORMAT_FUNCTION_NAME = 'pentatonic_hero.control.display_format'
+
+FORMAT_JSON = 'json'
+FORMAT_PACKED = 'packed'
+FORMAT_AUTO = 'auto'  # json, except packed to the display hub clients that ask for it
+FORMATS = (FORMAT_AUTO, FORMAT_JSON, FORMAT_PACKED)
+
+OPCODES = {
+    'button_down': 1,
+    'button_up': 2,
+    'note_on': 3,
+    'note_off': 4,
+    'strum': 5,
+    'pitch': 6,
+}
+EVENTS = {opcode: event for event, opcode in OPCODES.items()}
+OP_PITCH = OPCODES['pitch']
+OP_NOTE_ON = OPCODES['note_on']
+
+NO_BUTTON = 0xFF
+PITCH_SCALE = 8191  # pitch -1.0 .. 1.0 as int16
+VELOCITY_SCALE = 255
+MAX_DELTA_MS = 0xFFFF
+
+OPCODE, INPUT, TIMESTAMP = 0, 1, 2
+
+
+# Records ----------------------------------------------------------------------
+
+class Record(list):
+    """
+    [opcode, input, timestamp_ns, button, value, velocity] - a list so a queued pitch record can be superseded in place
+    """
+    __slots__ = ()
+
+
+def record(event, input, timestamp, button=None, value=0, velocity=0.0, pitch=None):
+    """
+    A display event as a record [opcode, input, timestamp_ns, button, value, velocity]
+    """
+    if pitch is not None:
+        value = round(pitch * PITCH_SCALE)
+    return Record((
+        OPCODES[event],
+        input,
+        timestamp,
+        NO_BUTTON if button is None else button,
+        value,
+        min(VELOCITY_SCALE, max(0, round(velocity * VELOCITY_SCALE))),
+    ))
+
+
+def is_record(data):
+    return isinstance(data, Record)
+
+
+def pitch_input(data):
+    """
+    The input of a queued pitch message or record (None for anything else)
+    """
+    if isinstance(data, dict):
+        return data.get('input') if data.get('event') == 'pitch' else None
+    if is_record(data) and data[OPCODE] == OP_PITCH:
+        return data[INPUT]
+    return None
+
+
+def supersede(queued, data):
+    """
+    Replace a queued message with a newer one in place
+    """
+    if isinstance(queued, dict):
+        queued.update(data)
+    else:
+        queued[:] = data
+
+
+# Packing ----------------------------------------------------------------------
+
+def pack(records):
+    buffer = bytearray(HEADER.size + RECORD.size * len(records))
+    previous_ms = records[0][TIMESTAMP] // 1000000 if records else 0
+    HEADER.pack_into(buffer, 0, VERSION, len(records), previous_ms)
+    offset = HEADER.size
+    for opcode, input, timestamp, button, value, velocity in records:
+        timestamp_ms = timestamp // 1000000
+        RECORD.pack_into(buffer, offset, opcode, input, min(MAX_DELTA_MS, max(0, timestamp_ms - previous_ms)), button, value, velocity)
+        previous_ms = timestamp_ms
+        offset += RECORD.size
+    return {
+        'func': EVENT_DISPLAY_FUNCTION_NAME,
+        'event': EVENT_PACKED,
+        'data': base64.b64encode(buffer).decode('ascii'),
+    }
+
+
+def pack_batch(batch):
+    """
+    Replace each run of records in a batch with one packed message (json messages are kept in order)
+    """
+    packed = []
+    records = []
+    for data in batch:
+        if is_record(data):
+            records.append(data)
+            continue
+        if records:
+            packed.append(pack(records))
+            records = []
+        packed.append(data)
+    if records:
+        packed.append(pack(records))
+    return packed
+
+
+def unpack(data):
+    """
+    A packed message's data back to display event dicts (timestamps in ms)
+    """
+    buffer = base64.b64decode(data)
+    version, count, timestamp = HEADER.unpack_from(buffer, 0)
+    assert version == VERSION, 'unsupported packed display event version {0}'.format(version)
+    events = []
+    for opcode, input, delta, button, value, velocity in RECORD.iter_unpack(buffer[HEADER.size:HEADER.size + RECORD.size * count]):
+        timestamp += delta
+        events.append(_event({'timestamp': timestamp}, opcode, input, button, value, velocity))
+    return events
+
+
+def json_batch(data):
+    """
+    A message, record or batch with every record replaced by its json message
+    """
+    if is_record(data):
+        return message(data)
+    if isinstance(data, list):
+        return [message(item) if is_record(item) else item for item in data]
+    return data
+
+
+def packed_batch(data):
+    """
+    A message, record or batch with the records packed
+    """
+    if is_record(data):
+        return pack([data])
+    if isinstance(data, list):
+        return pack_batch(data)
+    return data
+
+
+def message(record):
+    """
+    A record as the json display message it replaces
+    """
+    opcode, input, timestamp, button, value, velocity = record
+    return _event({'func': EVENT_DISPLAY_FUNCTION_NAME, 'timestamp': timestamp // 1000000}, opcode, input, button, value, velocity)
+
+
+def _event(event, opcode, input, button, value, velocity):
+    event['event'] = EVENTS[opcode]
+    event['input'] = input
+    if button != NO_BUTTON:
+        event['button'] = button
+    if opcode == OP_PITCH:
+        event['pitch'] = value / PITCH_SCALE
+    else:
+        event['value'] = value
+    if opcode == OP_NOTE_ON:
+        event['velocity'] = velocity / VELOCITY_SCALE
+    return event
+
+
+# Display ----------------------------------------------------------------------
+
+class PackedDisplay(object):
+    """
+    Wraps a display (e.g. SubscriptionClient) to pack any records before they are sent.
+    json messages pass straight through.
+    """
+    def __init__(self, display):
+        self.display = display
+
+    def send_message(self, data):
+        self.display.send_message(packed_batch(data))
+
+    def close(self):
+        self.display.close()
@@ -0,0 +1,494 @@
+""" Pentatonic Hero - In process display broadcast hub
+
+Display clients (the browser visualisation, the DMX lighting renderer) can
+connect straight to pentatonic_hero rather than through an external display
+server:
+
+    tcp        json messages, one per line, in both directions
+    websocket  json messages in text frames, in both directions
+
+Each message (normally a batch list from DisplayEventQueue) is serialised once
+and the same encoded frame is queued to every client. Sending never blocks: a
+client that falls more than max_buffer bytes behind is disconnected.
+
+Display format is per client. Records (see display_codec) are sent as json
+messages, or packed to clients that asked for packed events with a
+display_codec.FORMAT_FUNCTION_NAME message when the format is auto. Each
+format is encoded at most once per batch.
+
+Messages from clients (control commands e.g. pentatonic_hero.control.mute) are
+passed to recive_message on the hub thread, as SubscriptionClient does.
+"""
+
+# Imports ----------------------------------------------------------------------
+import json
+import base64
+import socket
+import struct
+import hashlib
+import selectors
+import threading
+
+import display_codec
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_MAX_BUFFER = 256 * 1024  # bytes queued for a client before it is dropped
+MAX_INCOMING = 64 * 1024  # longest message accepted from a client
+RECV_SIZE = 65536
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_RESPONSE = 'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {0}\r\n\r\n'
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+FIN = 0x80
+MASKED = 0x80
+
+
+# WebSocket --------------------------------------------------------------------
+
+def websocket_accept(key):
+    """
+    >>> websocket_accept('dGhlIHNhbXBsZSBub25jZQ==')
+    's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+    """
+    return base64.b64encode(hashlib.sha1(key.encode('ascii') + WEBSOCKET_GUID).digest()).decode('ascii')
+
+
+def websocket_frame(payload, opcode=OPCODE_TEXT):
+    """
+    An unmasked (server to client) frame
+
+    >>> websocket_frame(b'hi').hex()
+    '81026869'
+    >>> websocket_frame(bytes(200))[:4].hex()
+    '817e00c8'
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', FIN | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('>BBH', FIN | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', FIN | opcode, 127, length)
+    return header + payload
+
+
+def unmask(payload, mask):
+    """
+    >>> unmask(unmask(b'hello', b'abcd'), b'abcd')
+    b'hello'
+    """
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+def read_websocket_frame(buffer):
+    """
+    (fin, opcode, payload, frame length) of the first complete frame in buffer, or None
+
+    >>> read_websocket_frame(bytes.fromhex('8182') + b'abcd' + unmask(b'{}', b'abcd'))
+    (True, 1, b'{}', 8)
+    >>> read_websocket_frame(bytes.fromhex('8182') + b'abc') is None
+    True
+    """
+    if len(buffer) < 2:
+        return None
+    first, second = buffer[0], buffer[1]
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        if len(buffer) < 4:
+            return None
+        length, = struct.unpack_from('>H', buffer, 2)
+        offset = 4
+    elif length == 127:
+        if len(buffer) < 10:
+            return None
+        length, = struct.unpack_from('>Q', buffer, 2)
+        offset = 10
+    mask = None
+    if second & MASKED:
+        if len(buffer) < offset + 4:
+            return None
+        mask = bytes(buffer[offset:offset + 4])
+        offset += 4
+    if len(buffer) < offset + length:
+        return None
+    payload = bytes(buffer[offset:offset + length])
+    if mask:
+        payload = unmask(payload, mask)
+    return bool(first & FIN), first & 0x0F, payload, offset + length
+
+
+# Hub --------------------------------------------------------------------------
+
+class _Client(object):
+    def __init__(self, sock, address, websocket):
+        self.sock = sock
+        self.address = address
+        self.websocket = websocket
+        self.handshaken = not websocket
+        self.incoming = bytearray()
+        self.fragments = bytearray()
+        self.outgoing = bytearray()
+        self.events = selectors.EVENT_READ
+        self.closed = False
+        self.packed = False  # Asked for packed display events
+
+    @property
+    def name(self):
+        return '{0} {1}:{2}'.format('websocket' if self.websocket else 'tcp', *self.address[:2])
+
+
+class DisplayHub(object):
+    """
+    Accepts tcp and websocket display clients on a background thread.
+    Presents the same send_message/recive_message/close interface as SubscriptionClient.
+    A port of None disables that listener; port 0 picks a free port (see addresses).
+
+    >>> import time
+    >>> def wait(condition):
+    ...     deadline = time.monotonic() + 5
+    ...     while not condition() and time.monotonic() < deadline:
+    ...         time.sleep(0.01)
+    ...     return condition()
+    >>> hub = DisplayHub('127.0.0.1', 0, 0, max_buffer=4096)
+    >>> received = []
+    >>> hub.recive_message = received.append
+    >>> tcp_address, websocket_address = hub.addresses
+    >>> tcp = socket.create_connection(tcp_address)
+    >>> websocket = socket.create_connection(websocket_address)
+    >>> websocket.sendall(b'GET / HTTP/1.1\\r\\nUpgrade: websocket\\r\\nConnection: Upgrade\\r\\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\\r\\n\\r\\n')
+    >>> websocket.recv(RECV_SIZE).split(b'\\r\\n')[0]
+    b'HTTP/1.1 101 Switching Protocols'
+    >>> wait(lambda: len(hub.clients) == 2)
+    True
+
+    Each client gets the batch once, in its own framing
+
+    >>> hub.send_message([{'event': 'note_on', 'input': 1, 'value': 57}])
+    >>> tcp.recv(RECV_SIZE)
+    b'[{"event": "note_on", "input": 1, "value": 57}]\\n'
+    >>> read_websocket_frame(websocket.recv(RECV_SIZE))[:3]
+    (True, 1, b'[{"event": "note_on", "input": 1, "value": 57}]')
+
+    Control commands from clients reach recive_message
+
+    >>> tcp.sendall(b'{"func": "pentatonic_hero.control.mute", "input": "player1"}\\n')
+    >>> wait(lambda: len(received) == 1)
+    True
+    >>> received
+    [{'func': 'pentatonic_hero.control.mute', 'input': 'player1'}]
+
+    A client that stops reading is dropped once it is max_buffer behind
+
+    >>> tcp.close(); websocket.close()
+    >>> wait(lambda: not hub.clients)
+    True
+    >>> slow = socket.socket()
+    >>> slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    >>> slow.connect(tcp_address)
+    >>> wait(lambda: len(hub.clients) == 1)
+    True
+    >>> for _ in range(4096):
+    ...     hub.send_message('x' * 16384)
+    ...     if hub.dropped:
+    ...         break
+    >>> hub.dropped, len(hub.clients)
+    (1, 0)
+    >>> hub.close(); slow.close()
+    """
+    def __init__(self, host='localhost', port=None, websocket_port=None, max_buffer=DEFAULT_MAX_BUFFER, display_format=display_codec.FORMAT_AUTO):
+        self.max_buffer = max_buffer
+        self.display_format = display_format
+        self.lock = threading.Lock()  # Guards clients and their outgoing buffers
+        self.clients = set()
+        self.closing = []
+        self.selector = selectors.DefaultSelector()
+        self.listeners = []
+        for listen_port, websocket in ((port, False), (websocket_port, True)):
+            if listen_port is None:
+                continue
+            listener = socket.create_server((host, int(listen_port)))
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, websocket)
+            self.listeners.append(listener)
+            log.info('display hub: {0} clients on {1}:{2}'.format('websocket' if websocket else 'tcp', *listener.getsockname()[:2]))
+        self.wake_receive, self.wake_send = socket.socketpair()
+        self.wake_receive.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_receive, selectors.EVENT_READ, None)
+
+        self.messages = 0
+        self.dropped = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='display_hub')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def addresses(self):
+        return [listener.getsockname()[:2] for listener in self.listeners]
+
+    def recive_message(self, data):
+        """
+        Replaced by the owner to handle messages from clients
+        """
+        pass
+
+    # Sending (any thread) -----------------------------------------------------
+
+    def _packed(self, client):
+        if self.display_format == display_codec.FORMAT_AUTO:
+            return client.packed
+        return self.display_format == display_codec.FORMAT_PACKED
+
+    def send_message(self, data):
+        payloads = {}  # packed -> serialised message, each built once per message
+        frames = {}  # (packed, websocket) -> the payload as a line or websocket frame
+        with self.lock:
+            for client in tuple(self.clients):  # Slow clients are removed as we go
+                if not client.handshaken:
+                    continue
+                packed = self._packed(client)
+                key = (packed, client.websocket)
+                frame = frames.get(key)
+                if frame is None:
+                    payload = payloads.get(packed)
+                    if payload is None:
+                        payload = payloads[packed] = json.dumps(display_codec.packed_batch(data) if packed else display_codec.json_batch(data)).encode('utf8')
+                    frame = frames[key] = websocket_frame(payload) if client.websocket else payload + b'\n'
+                self._queue(client, frame)
+            self.messages += 1
+
+    def _queue(self, client, data):
+        """
+        Send now if the client is keeping up, otherwise buffer for the hub thread (lock held)
+        """
+        if client.closed:
+            return
+        if client.outgoing:
+            if len(client.outgoing) + len(data) > self.max_buffer:
+                self.dropped += 1
+                log.warning('display hub: dropping slow client {0} ({1} bytes behind)'.format(client.name, len(client.outgoing)))
+                self._close(client)
+                return
+            client.outgoing += data
+            return
+        try:
+            sent = client.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(client)
+            return
+        if sent < len(data):
+            client.outgoing += memoryview(data)[sent:]
+            self._wake()
+
+    def _close(self, client):
+        """
+        Forget a client - the socket is closed on the hub thread (lock held)
+        """
+        if client.closed:
+            return
+        client.closed = True
+        self.clients.discard(client)
+        self.closing.append(client)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Already awake
+
+    # Hub thread ---------------------------------------------------------------
+
+    def _run(self):
+        while self.running:
+            for key, events in self.selector.select():
+                data = key.data
+                if data is None:
+                    try:
+                        while self.wake_receive.recv(RECV_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif isinstance(data, bool):
+                    self._accept(key.fileobj, data)
+                else:
+                    if events & selectors.EVENT_WRITE:
+                        with self.lock:
+                            self._flush(data)
+                    if events & selectors.EVENT_READ:
+                        self._read(data)
+            self._update()
+        with self.lock:
+            for client in tuple(self.clients):
+                self._flush(client)
+                self._close(client)
+        self._update()
+        for listener in self.listeners:
+            self.selector.unregister(listener)
+            listener.close()
+        self.selector.close()
+        self.wake_receive.close()
+        self.wake_send.close()
+
+    def _accept(self, listener, websocket):
+        try:
+            sock, address = listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _Client(sock, address, websocket)
+        self.selector.register(sock, client.events, client)
+        with self.lock:
+            self.clients.add(client)
+        log.info('display hub: {0} connected'.format(client.name))
+
+    def _update(self):
+        """
+        Close dropped clients and watch for writability only while a client has data buffered
+        """
+        with self.lock:
+            closing, self.closing = self.closing, []
+            for client in self.clients:
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outgoing else 0)
+                if events != client.events:
+                    client.events = events
+                    self.selector.modify(client.sock, events, client)
+        for client in closing:
+            self.selector.unregister(client.sock)
+            client.sock.close()
+            log.info('display hub: {0} disconnected'.format(client.name))
+
+    def _flush(self, client):
+        """
+        Send as much of a client's buffered data as it will take (lock held)
+        """
+        if client.closed or not client.outgoing:
+            return
+        try:
+            sent = client.sock.send(client.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(client)
+            return
+        del client.outgoing[:sent]
+
+    def _read(self, client):
+        if client.closed:
+            return
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            with self.lock:
+                self._close(client)
+            return
+        client.incoming += data
+        if not client.handshaken:
+            self._handshake(client)
+        if client.websocket:
+            self._read_frames(client)
+        else:
+            self._read_lines(client)
+        if len(client.incoming) > MAX_INCOMING:
+            log.warning('display hub: {0} sent an oversized message'.format(client.name))
+            with self.lock:
+                self._close(client)
+
+    def _handshake(self, client):
+        end = client.incoming.find(b'\r\n\r\n')
+        if end < 0:
+            return
+        request = bytes(client.incoming[:end]).decode('latin-1')
+        del client.incoming[:end + 4]
+        headers = {}
+        for line in request.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        with self.lock:
+            if not key:
+                self._queue(client, b'HTTP/1.1 400 Bad Request\r\n\r\n')
+                self._close(client)
+                return
+            self._queue(client, WEBSOCKET_RESPONSE.format(websocket_accept(key)).encode('ascii'))
+            client.handshaken = True
+
+    def _read_lines(self, client):
+        while not client.closed:
+            end = client.incoming.find(b'\n')
+            if end < 0:
+                return
+            line = bytes(client.incoming[:end])
+            del client.incoming[:end + 1]
+            if line.strip():
+                self._recive(client, line)
+
+    def _read_frames(self, client):
+        while client.handshaken and not client.closed:
+            frame = read_websocket_frame(client.incoming)
+            if not frame:
+                return
+            fin, opcode, payload, length = frame
+            del client.incoming[:length]
+            if opcode == OPCODE_CLOSE:
+                with self.lock:
+                    self._queue(client, websocket_frame(payload[:2], OPCODE_CLOSE))
+                    self._close(client)
+            elif opcode == OPCODE_PING:
+                with self.lock:
+                    self._queue(client, websocket_frame(payload, OPCODE_PONG))
+            elif opcode in (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONTINUATION):
+                client.fragments += payload
+                if fin:
+                    message, client.fragments = bytes(client.fragments), bytearray()
+                    self._recive(client, message)
+
+    def _recive(self, client, message):
+        try:
+            data = json.loads(message.decode('utf8'))
+        except ValueError:
+            log.warning('display hub: {0} sent invalid json'.format(client.name))
+            return
+        if isinstance(data, dict) and data.get('func') == display_codec.FORMAT_FUNCTION_NAME:
+            client.packed = display_codec.FORMAT_PACKED in data.get('formats', ())
+            log.info('display hub: {0} display format {1}'.format(client.name, display_codec.FORMAT_PACKED if self._packed(client) else display_codec.FORMAT_JSON))
+            return
+        try:
+            self.recive_message(data)
+        except Exception as ex:
+            log.warning('display hub: {0} message failed: {1}'.format(client.name, ex))
+
+    @property
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'messages': self.messages,
+            'dropped': self.dropped,
+        }
+
+    def close(self):
+        self.running = False
+        self._wake()
+        self.thread.join(1.0)
+        log.info('display hub: {0[messages]} messages sent, {0[dropped]} slow clients dropped'.format(self.stats))
@@ -0,0 +1,168 @@
+""" Pentatonic Hero - Non blocking batched display event pipeline """
+
+# Imports ----------------------------------------------------------------------
+import threading
+from collections import deque
+
+from display_codec import pitch_input, supersede
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_BATCH_SIZE = 64
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+
+# Queue ------------------------------------------------------------------------
+
+class DisplayEventQueue(object):
+    """
+    Queue display messages and send them in list batches from a background thread,
+    so a slow or reconnecting display host never delays note output.
+
+    Presents the same send_message interface as SubscriptionClient and can be handed
+    to HeroInput as its display.
+
+    A queued 'pitch' event (json or packed record) is superseded by a newer one from the same input
+    (the newer value is written into the queued message rather than queuing another).
+
+    With threaded=False no sender thread is started; the owner drains the queue with
+    take_batch/send_batch (e.g. from an asyncio task) and is told of new messages with notify.
+
+    >>> class Display(object):
+    ...     def __init__(self):
+    ...         self.sent = []
+    ...     def send_message(self, data):
+    ...         self.sent.append(data)
+    >>> display = Display()
+    >>> queue = DisplayEventQueue(display, queue_size=3, threaded=False)
+    >>> queue.send_message({'event': 'pitch', 'input': 1, 'pitch': 0.1})
+    >>> queue.send_message({'event': 'pitch', 'input': 1, 'pitch': 0.5})  # Written into the queued pitch
+    >>> queue.send_message({'event': 'pitch', 'input': 2, 'pitch': 0.2})
+    >>> [data['pitch'] for data in queue.queue]
+    [0.5, 0.2]
+    >>> queue.send_message({'event': 'note_on', 'input': 1, 'value': 57})
+    >>> queue.send_message({'event': 'note_off', 'input': 1, 'value': 57})  # Full - the oldest is dropped
+    >>> queue.send_message({'event': 'pitch', 'input': 1, 'pitch': 0.9})  # Its dropped pitch is not collapsed into
+    >>> [data['event'] for data in queue.queue]
+    ['note_on', 'note_off', 'pitch']
+    >>> queue.send_batch(queue.take_batch())
+    >>> len(display.sent[0]), queue.stats
+    (3, {'dropped': 2, 'collapsed': 1, 'batched': 3, 'batches': 1})
+
+    >>> queue = DisplayEventQueue(display, queue_size=2, drop_policy=DROP_NEWEST, threaded=False)
+    >>> for value in (1, 2, 3):
+    ...     queue.send_message({'event': 'note_on', 'input': 1, 'value': value})
+    >>> queue.close()
+    >>> [data['value'] for data in display.sent[-1]], queue.dropped
+    ([1, 2], 1)
+    """
+    def __init__(self, display, queue_size=DEFAULT_QUEUE_SIZE, drop_policy=DROP_OLDEST, batch_size=DEFAULT_BATCH_SIZE, threaded=True, notify=None):
+        assert drop_policy in DROP_POLICIES, 'drop_policy must be one of {0}'.format(DROP_POLICIES)
+        self.display = display
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.batch_size = batch_size
+
+        self.queue = deque()
+        self.pending_pitch = {}  # input -> queued pitch message
+        self.condition = threading.Condition()
+
+        self.dropped = 0
+        self.collapsed = 0
+        self.batched = 0
+        self.batches = 0
+
+        self.notify = notify
+        self.running = True
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self._run, name='display_event_queue')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def send_message(self, data):
+        with self.condition:
+            input = pitch_input(data)
+            if input is not None:
+                queued = self.pending_pitch.get(input)
+                if queued is not None:
+                    supersede(queued, data)
+                    self.collapsed += 1
+                    return
+                self.pending_pitch[input] = data
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    self._forget_pitch(data)
+                    return
+                self._forget_pitch(self.queue.popleft())
+            self.queue.append(data)
+            self.condition.notify()
+        if self.notify:
+            self.notify()
+
+    def _forget_pitch(self, data):
+        input = pitch_input(data)
+        if input is not None and self.pending_pitch.get(input) is data:
+            del self.pending_pitch[input]
+
+    def _take_batch(self):
+        batch = []
+        while self.queue and len(batch) < self.batch_size:
+            data = self.queue.popleft()
+            self._forget_pitch(data)
+            batch.append(data)
+        return batch
+
+    def take_batch(self):
+        with self.condition:
+            return self._take_batch()
+
+    def send_batch(self, batch):
+        try:
+            self.display.send_message(batch)
+        except Exception as ex:
+            log.warning('display send failed: {0}'.format(ex))
+        self.batches += 1
+        self.batched += len(batch)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.running and not self.queue:
+                    return
+                batch = self._take_batch()
+            self.send_batch(batch)
+
+    @property
+    def stats(self):
+        return {
+            'dropped': self.dropped,
+            'collapsed': self.collapsed,
+            'batched': self.batched,
+            'batches': self.batches,
+        }
+
+    def close(self, timeout=1.0):
+        """
+        Send anything still queued and stop the sender thread
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+        else:
+            batch = self.take_batch()
+            while batch:
+                self.send_batch(batch)
+                batch = self.take_batch()
+        log.info('display queue: {0[batched]} messages in {0[batches]} batches, {0[collapsed]} pitch collapsed, {0[dropped]} dropped'.format(self.stats))
@@ -0,0 +1,145 @@
+""" Pentatonic Hero - Compact binary input event recording and replay
+
+Each event is a fixed width little endian record:
+
+    timestamp (int64 monotonic ns), type (uint32), joy (int16, -1 for none),
+    button/axis/hat/key (int32), value (2 x float64 - axis value or hat x,y)
+
+Axis values are kept as the doubles pygame reported, so a replay crosses the
+same thresholds and quantises pitch bend exactly as the live run did.
+
+>>> import os, tempfile
+>>> filename = os.path.join(tempfile.mkdtemp(), 'events.log')
+>>> recorder = EventRecorder(filename, buffer_records=2)
+>>> recorder.record(pygame.event.Event(pygame.JOYBUTTONDOWN, joy=0, button=3), 1000)
+>>> recorder.record(pygame.event.Event(pygame.JOYAXISMOTION, joy=1, axis=2, value=0.1), 2000)
+>>> recorder.record(pygame.event.Event(pygame.JOYHATMOTION, joy=0, hat=0, value=(-1, 1)), 3000)
+>>> recorder.record(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_a), 4000)
+>>> recorder.close()
+>>> with open(filename, 'ab') as filehandle:
+...     _ = filehandle.write(bytes(RECORD.size - 1))  # A record cut short by a crash
+>>> for timestamp, event in read_events(filename, buffer_records=3):
+...     print(timestamp, pygame.event.event_name(event.type), event.dict)
+1000 JoyButtonDown {'joy': 0, 'button': 3}
+2000 JoyAxisMotion {'joy': 1, 'axis': 2, 'value': 0.1}
+3000 JoyHatMotion {'joy': 0, 'hat': 0, 'value': (-1, 1)}
+4000 KeyDown {'key': 97}
+>>> first_timestamp(filename)
+1000
+"""
+
+# Imports ----------------------------------------------------------------------
+import struct
+
+import pygame
+
+from controls import EVENT_INPUT_ATTRIBUTE
+
+# Constants --------------------------------------------------------------------
+
+HEADER = b'PHEL\x02\x00\x00\x00'
+RECORD = struct.Struct('<qIhidd')
+DEFAULT_BUFFER_RECORDS = 1024
+NO_JOY = -1
+
+
+# Recording --------------------------------------------------------------------
+
+class EventRecorder(object):
+    """
+    Append pygame events to a binary log.
+    Records are packed into a preallocated buffer that is written out when full.
+    """
+    def __init__(self, filename, buffer_records=DEFAULT_BUFFER_RECORDS):
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER)
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.offset = 0
+        self.records = 0
+
+    def record(self, event, timestamp):
+        attribute = EVENT_INPUT_ATTRIBUTE.get(event.type)
+        value = getattr(event, 'value', 0) if attribute in ('axis', 'hat') else 0
+        if isinstance(value, tuple):
+            value0, value1 = value
+        else:
+            value0, value1 = value, 0
+        joy = getattr(event, 'joy', None)
+        RECORD.pack_into(
+            self.buffer, self.offset,
+            timestamp,
+            event.type,
+            NO_JOY if joy is None else joy,
+            getattr(event, attribute) if attribute else 0,
+            value0,
+            value1,
+        )
+        self.offset += RECORD.size
+        self.records += 1
+        if self.offset >= len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# Replay -----------------------------------------------------------------------
+
+def _event(event_type, joy, code, value0, value1):
+    attributes = {}
+    if joy != NO_JOY:
+        attributes['joy'] = joy
+    attribute = EVENT_INPUT_ATTRIBUTE.get(event_type)
+    if attribute:
+        attributes[attribute] = code
+    if attribute == 'axis':
+        attributes['value'] = value0
+    if attribute == 'hat':
+        attributes['value'] = (int(value0), int(value1))
+    return pygame.event.Event(event_type, attributes)
+
+
+def read_events(filename, buffer_records=DEFAULT_BUFFER_RECORDS):
+    """
+    Generator of (timestamp, pygame event) from a binary log, read in fixed size chunks
+    """
+    with open(filename, 'rb') as filehandle:
+        header = filehandle.read(len(HEADER))
+        if header != HEADER:
+            if header[:4] == HEADER[:4]:
+                raise ValueError('{0} is an event log from an older version (format {1}) - record it again'.format(filename, header[4]))
+            raise ValueError('{0} is not a pentatonic hero event log'.format(filename))
+        while True:
+            chunk = filehandle.read(RECORD.size * buffer_records)
+            if not chunk:
+                break
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]  # Ignore a truncated final record
+            for timestamp, event_type, joy, code, value0, value1 in RECORD.iter_unpack(chunk):
+                yield timestamp, _event(event_type, joy, code, value0, value1)
+
+
+def first_timestamp(filename):
+    """
+    The timestamp of the first event in a log (0 if it is empty) - replay clocks start here,
+    so timers scheduled before the first event are not due from time 0
+    """
+    events = read_events(filename, buffer_records=1)
+    timestamp, event = next(events, (0, None))
+    events.close()
+    return timestamp
+
+
+class ReplayClock(object):
+    """
+    A clock that reports the timestamp of the event currently being replayed
+    """
+    def __init__(self, timestamp=0):
+        self.timestamp = timestamp
+
+    def __call__(self):
+        return self.timestamp
@@ -0,0 +1,147 @@
+""" Pentatonic Hero - Joystick hot-plug
+
+Input profiles address joysticks by number ('joy' in controls.py). Here that
+number is a logical slot: slot n is bound to the device that was joystick n at
+startup and remembers its GUID and name.
+
+When a device is unplugged its slot is freed (the caller releases the players
+reading it). When a device is plugged in only that device is opened, and it is
+bound to the free slot that last held the same GUID, else the same name, else
+the lowest slot a profile reads that has never been bound. From then on its
+events carry that slot's joy number, so the profiles and HeroInputs that read
+it carry on without a restart.
+
+With --input_shards every process sees every device being plugged in, so only
+slots that were bound at startup are rebound (bind_new=False) - otherwise one
+controller could be taken by a never bound slot in several processes.
+"""
+
+# Imports ----------------------------------------------------------------------
+import pygame
+
+from latency import clock_ns
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+HOTPLUG_EVENTS = frozenset((pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED))
+
+
+# Slots ------------------------------------------------------------------------
+
+class JoystickSlot(object):
+    __slots__ = ('joy', 'guid', 'name', 'joystick')
+
+    def __init__(self, joy):
+        self.joy = joy
+        self.guid = None
+        self.name = None
+        self.joystick = None
+
+
+class JoystickSlots(object):
+    """
+    joysticks is the set of joy numbers the input profiles read (None binds any device to the lowest free slot)
+    bind_new: bind devices to slots that have never been bound, else only rebind slots by GUID or name
+    """
+    def __init__(self, joysticks=None, clock=clock_ns, bind_new=True):
+        self.joysticks = None if joysticks is None else frozenset(joysticks)
+        self.clock = clock
+        self.bind_new = bind_new
+        self.slots = {}  # joy -> JoystickSlot
+        self.instances = {}  # SDL instance id -> joy
+        self.reconnecting = {}  # joy -> reconnect timestamp, until the first note is played
+        self.reconnect_times = []  # ns from reconnect to first note
+
+    def bind(self, joy, joystick):
+        joystick.init()
+        slot = self.slots.get(joy) or self.slots.setdefault(joy, JoystickSlot(joy))
+        slot.guid = joystick.get_guid()
+        slot.name = joystick.get_name()
+        slot.joystick = joystick
+        self.instances[joystick.get_instance_id()] = joy
+        return slot
+
+    def _free_slot(self, guid, name):
+        free = [slot for joy, slot in sorted(self.slots.items()) if not slot.joystick]
+        for slot in free:
+            if slot.guid == guid:
+                return slot.joy
+        for slot in free:
+            if slot.name == name:
+                return slot.joy
+        if not self.bind_new:
+            return None
+        if self.joysticks is None:
+            joy = 0
+            while joy in self.slots and self.slots[joy].joystick:
+                joy += 1
+            return joy
+        for joy in sorted(self.joysticks):
+            if joy not in self.slots:
+                return joy
+        return None
+
+    def add(self, device_index):
+        """
+        Open a plugged in device and bind it to a slot. Returns the joy number, or None if it is not needed
+        """
+        joystick = pygame.joystick.Joystick(device_index)
+        if joystick.get_instance_id() in self.instances:
+            return None  # Already bound (SDL also announces the devices present at startup)
+        joy = self._free_slot(joystick.get_guid(), joystick.get_name())
+        if joy is None:
+            log.info('joystick connected: {0} - {1}'.format(joystick.get_name(), 'not read by any input profile' if self.bind_new else 'not bound here (with --input_shards only joysticks present at startup are rebound)'))
+            joystick.quit()
+            return None
+        reconnect = joy in self.slots
+        self.bind(joy, joystick)
+        if reconnect:
+            self.reconnecting[joy] = self.clock()
+        log.info('joystick {0} {1}: {2}'.format(joy, 'reconnected' if reconnect else 'connected', joystick.get_name()))
+        return joy
+
+    def remove(self, instance_id):
+        """
+        Free the slot of an unplugged device. Returns its joy number (None for devices that were not bound)
+        """
+        joy = self.instances.pop(instance_id, None)
+        if joy is None:
+            return None
+        slot = self.slots[joy]
+        slot.joystick.quit()
+        slot.joystick = None
+        self.reconnecting.pop(joy, None)
+        log.warning('joystick {0} disconnected: {1}'.format(joy, slot.name))
+        return joy
+
+    def map_event(self, event):
+        """
+        Give a live joystick event the joy number of its slot.
+        Returns False for events from devices that are not bound to a slot.
+        """
+        instance_id = getattr(event, 'instance_id', None)
+        if instance_id is None:
+            return True  # Not a joystick event (or replayed with its slot joy number already)
+        joy = self.instances.get(instance_id)
+        if joy is None:
+            return False
+        event.joy = joy
+        return True
+
+    def note_played(self, joy):
+        """
+        Record the time from the reconnect of joy to its first note
+        """
+        reconnected = self.reconnecting.pop(joy, None)
+        if reconnected is None:
+            return
+        elapsed = self.clock() - reconnected
+        self.reconnect_times.append(elapsed)
+        log.info('joystick {0}: first note {1:.1f}ms after reconnect'.format(joy, elapsed / 1000000))
+
+    def log_summary(self):
+        if self.reconnect_times:
+            log.info('joystick reconnects: {0}, reconnect to first note max {1:.1f}ms'.format(len(self.reconnect_times), max(self.reconnect_times) / 1000000))
@@ -0,0 +1,182 @@
+""" Pentatonic Hero - Input to midi latency instrumentation """
+
+# Imports ----------------------------------------------------------------------
+import time
+from array import array
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+clock_ns = time.monotonic_ns
+
+HISTOGRAM_BUCKET_US = 10  # Resolution of each histogram bucket in microseconds
+HISTOGRAM_BUCKETS = 5000  # 50ms of range - anything slower lands in the final bucket
+
+STAGES = ('processed', 'midi')
+
+
+# Histogram --------------------------------------------------------------------
+
+class LatencyHistogram(object):
+    """
+    Fixed size bucketed histogram of latencies.
+    Adding a sample is an integer divide and an array increment - no allocations.
+
+    >>> h = LatencyHistogram()
+    >>> for us in (100, 200, 300, 400, 10000):
+    ...     h.add(us * 1000)
+    >>> h.summary()
+    {'count': 5, 'p50': 310, 'p99': 10000, 'max': 10000}
+    """
+    def __init__(self, bucket_us=HISTOGRAM_BUCKET_US, buckets=HISTOGRAM_BUCKETS):
+        self.bucket_ns = bucket_us * 1000
+        self.buckets = array('L', [0]) * buckets
+        self.reset()
+
+    def reset(self):
+        for index in range(len(self.buckets)):
+            self.buckets[index] = 0
+        self.count = 0
+        self.max = 0
+
+    def add(self, duration_ns):
+        bucket = duration_ns // self.bucket_ns
+        if bucket >= len(self.buckets):
+            bucket = len(self.buckets) - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        if duration_ns > self.max:
+            self.max = duration_ns
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket containing the percentile, in microseconds
+        """
+        if not self.count:
+            return 0
+        target = self.count * percent / 100
+        total = 0
+        for bucket, count in enumerate(self.buckets):
+            total += count
+            if total >= target:
+                return min((bucket + 1) * self.bucket_ns, self.max) // 1000
+        return self.max // 1000
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max // 1000,
+        }
+
+
+# Monitor ----------------------------------------------------------------------
+
+class PlayerLatency(object):
+    """
+    Latency histograms for a single HeroInput.
+    Each stage is measured from the moment the App received the input event.
+    """
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.processed = LatencyHistogram()
+        self.midi = LatencyHistogram()
+
+    def mark_processed(self):
+        self.processed.add(clock_ns() - self.monitor.event_timestamp)
+
+    def mark_midi(self):
+        if self.monitor.batched:
+            self.monitor.midi_pending.append(self)  # Measured when the batch is written - see LatencyMonitor.midi_written
+            return
+        self.midi.add(clock_ns() - self.monitor.event_timestamp)
+
+    def summary(self):
+        return {stage: getattr(self, stage).summary() for stage in STAGES}
+
+    def reset(self):
+        for stage in STAGES:
+            getattr(self, stage).reset()
+
+
+class PlayerLatencyNull(object):
+    def mark_processed(self):
+        pass
+
+    def mark_midi(self):
+        pass
+
+
+class LatencyMonitor(object):
+    """
+    With batched midi output the 'midi' stage is measured when MidiBatch writes the batch (midi_written),
+    not when the message is queued
+    """
+    def __init__(self, batched=False):
+        self.event_timestamp = clock_ns()
+        self.players = {}
+        self.batched = batched
+        self.midi_pending = []  # PlayerLatency with midi queued in the current batch
+
+    def player(self, name):
+        if name not in self.players:
+            self.players[name] = PlayerLatency(self)
+        return self.players[name]
+
+    def event_received(self):
+        self.event_timestamp = clock_ns()
+
+    def midi_written(self):
+        if not self.midi_pending:
+            return
+        duration = clock_ns() - self.event_timestamp
+        for player in self.midi_pending:
+            player.midi.add(duration)
+        self.midi_pending.clear()
+
+    def summary(self):
+        return {name: player.summary() for name, player in self.players.items()}
+
+    def log_summary(self, level=logging.INFO):
+        for name, player_summary in sorted(self.summary().items()):
+            for stage in STAGES:
+                log.log(level, '{0} {1} latency (us): {2[count]} events p50={2[p50]} p99={2[p99]} max={2[max]}'.format(name, stage, player_summary[stage]))
+
+
+# Startup ----------------------------------------------------------------------
+
+class StartupTimer(object):
+    """
+    Time taken by each named phase of startup
+
+    >>> now = [0]
+    >>> startup = StartupTimer(clock=lambda: now[0])
+    >>> now[0] = 2000000
+    >>> startup.phase('pygame')
+    >>> now[0] = 2500000
+    >>> startup.phase('midi')
+    >>> startup.summary()
+    'pygame 2.0ms, midi 0.5ms, total 2.5ms'
+    """
+    def __init__(self, clock=clock_ns):
+        self.clock = clock
+        self.started = self.previous = clock()
+        self.phases = []
+
+    def phase(self, name):
+        """
+        Mark the end of the named phase (it began at the end of the previous one)
+        """
+        now = self.clock()
+        self.phases.append((name, now - self.previous))
+        self.previous = now
+
+    @property
+    def total(self):
+        return self.previous - self.started
+
+    def summary(self):
+        return ', '.join('{0} {1:.1f}ms'.format(name, duration / 1000000) for name, duration in self.phases + [('total', self.total)])
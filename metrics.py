@@ -0,0 +1,47 @@
+""" Pentatonic Hero - Per player runtime counters """
+
+# Imports ----------------------------------------------------------------------
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+COUNTERS = (
+    'notes',  # note ons sent (strummed, hammer-ons and pull-offs)
+    'strums',
+    'hammer_ons',
+    'pull_offs',
+    'blocked_strums',  # strums dropped by hammer_strum_block_delay
+    'transposes',
+    'mutes',  # mute state changes
+    'midi_messages',
+)
+
+
+# Metrics ----------------------------------------------------------------------
+
+class PlayerMetrics(object):
+    """
+    Plain integer attributes - counting is a single attribute increment on the hot path
+
+    >>> metrics = PlayerMetrics()
+    >>> metrics.notes += 1
+    >>> metrics.snapshot()['notes']
+    1
+    """
+    __slots__ = COUNTERS
+
+    def __init__(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+
+    def snapshot(self):
+        return {counter: getattr(self, counter) for counter in COUNTERS}
+
+
+def log_metrics(players, level=logging.INFO):
+    """
+    players is a dict of name -> PlayerMetrics
+    """
+    for name, metrics in sorted(players.items()):
+        log.log(level, '{0} metrics: {1}'.format(name, ' '.join('{0}={1}'.format(counter, value) for counter, value in metrics.snapshot().items())))
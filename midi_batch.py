@@ -0,0 +1,118 @@
+""" Pentatonic Hero - Batched, timestamped midi output
+
+All the midi messages produced while handling one input event are collected
+and written to the portmidi device in a single timestamped write.
+
+In 'scheduled' mode the device is opened with a portmidi latency and every
+message is stamped with the portmidi time the input event was received, so
+output timing follows the input clock rather than Python scheduling jitter.
+"""
+
+# Imports ----------------------------------------------------------------------
+import pygame
+import pygame.midi
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+MODE_DIRECT = 'direct'  # Unbatched - each message written separately by PygameMidiOutputWrapper
+MODE_IMMEDIATE = 'immediate'
+MODE_SCHEDULED = 'scheduled'
+MODES = (MODE_DIRECT, MODE_IMMEDIATE, MODE_SCHEDULED)
+DEFAULT_LATENCY = 10  # ms - only used in scheduled mode
+
+NOTE_ON = 0x90
+PITCH_BEND = 0xE0
+PITCH_BEND_CENTER = 8192
+PITCH_BEND_MAX = 16383
+
+
+# Device -----------------------------------------------------------------------
+
+def open_output(port_name, latency=0):
+    """
+    Open the first midi output device with port_name in its name.
+    pygame.midi.Output only honours message timestamps when opened with a latency.
+    """
+    for device_id in range(pygame.midi.get_count()):
+        interface, name, is_input, is_output, is_opened = pygame.midi.get_device_info(device_id)
+        if is_output and port_name in name.decode('utf8', 'replace'):
+            log.info('midi output: {0} latency={1}ms'.format(name.decode('utf8', 'replace'), latency))
+            return pygame.midi.Output(device_id, latency=latency)
+    log.warning('Unable to locate midi output {0}'.format(port_name))
+    return None
+
+
+# Batch ------------------------------------------------------------------------
+
+class MidiBatch(object):
+    """
+    Shared by all players. Messages are queued by MidiBatchOutput and written by flush.
+    """
+    def __init__(self, midi_out, scheduled=False):
+        self.midi_out = midi_out
+        self.scheduled = scheduled
+        self.messages = []
+        self.timestamp = 0
+        self.written = None  # Called after each write e.g. LatencyMonitor.midi_written
+
+        self.writes = 0
+        self.messages_written = 0
+        self.max_messages_per_write = 0
+
+    def mark_input(self):
+        """
+        Stamp the following messages with the portmidi time of the input event
+        """
+        if self.scheduled:
+            self.timestamp = pygame.midi.time()
+
+    def append(self, status, data1, data2):
+        self.messages.append([[status, data1, data2], self.timestamp])
+
+    def flush(self):
+        if not self.messages:
+            return
+        messages, self.messages = self.messages, []
+        if self.midi_out:
+            self.midi_out.write(messages)
+        if self.written:
+            self.written()
+        self.writes += 1
+        self.messages_written += len(messages)
+        if len(messages) > self.max_messages_per_write:
+            self.max_messages_per_write = len(messages)
+
+    @property
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'messages': self.messages_written,
+            'messages_per_write': self.messages_written / self.writes if self.writes else 0,
+            'max_messages_per_write': self.max_messages_per_write,
+        }
+
+    def log_stats(self):
+        log.info('midi: {0[messages]} messages in {0[writes]} writes ({0[messages_per_write]:.2f} avg, {0[max_messages_per_write]} max per write)'.format(self.stats))
+
+
+class MidiBatchOutput(object):
+    """
+    A single channel of a MidiBatch.
+    Same note/pitch interface as PygameMidiOutputWrapper.
+    """
+    def __init__(self, batch, channel=0):
+        self.batch = batch
+        self.channel = channel
+
+    def note(self, note, velocity=1.0):
+        value = max(0, min(127, int(velocity * 127)))
+        if velocity > 0 and not value:
+            value = 1  # A faint hammer-on is still a note on, not a note off
+        self.batch.append(NOTE_ON | self.channel, note, value)
+
+    def pitch(self, pitch):
+        value = max(0, min(PITCH_BEND_MAX, PITCH_BEND_CENTER + int(pitch * (PITCH_BEND_CENTER - 1))))
+        self.batch.append(PITCH_BEND | self.channel, value & 0x7F, value >> 7)
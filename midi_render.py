@@ -0,0 +1,385 @@
+""" Pentatonic Hero - Offline rendering of recordings to Standard MIDI Files
+
+Streams a recorded input event log (see event_log.py) through HeroInputs on a
+virtual clock, or a json lines dump of display events, and writes a format 1
+Standard MIDI File with one track per player (each player has its own channel).
+
+Nothing waits for real time and every stage is a generator: track data is
+written to temporary files as it is produced and only copied into the .mid once
+each track's length is known, so memory use does not grow with the recording.
+
+    python3 midi_render.py show.log
+    python3 midi_render.py show.log -o show.mid -- --input_profiles ps3_joy1 ps3_joy2 --root_note C3
+    python3 midi_render.py --directory recordings/ --workers 4 -- --input_profiles ps3_joy1 ps3_joy2
+
+Options after -- are the pentatonic_hero.py options the recording was made with.
+
+A display dump has one json display message (or batch list of messages) per line.
+Display events carry their timestamp (ms since the clock's epoch - packed
+messages per record, json messages as 'timestamp'); messages without one
+(e.g. from older versions) are placed at the last timestamp seen.
+"""
+
+# Imports ----------------------------------------------------------------------
+import os
+import json
+import shutil
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import controls
+import display_codec
+from event_log import HEADER, ReplayClock, read_events, first_timestamp
+from midi_batch import MidiBatchOutput
+from scheduler import TimerScheduler
+from pentatonic_hero import HeroInput, MIDI_CHANNELS, get_args
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_DIVISION = 480  # ticks per quarter note
+DEFAULT_TEMPO = 120  # bpm - with the default division a tick is ~1ms
+MIDI_EXTENSION = '.mid'
+
+SMF_HEADER = struct.Struct('>4sIHHH')  # 'MThd', length, format, tracks, division
+SMF_TRACK = struct.Struct('>4sI')  # 'MTrk', length
+SMF_FORMAT = 1
+META_TRACK_NAME = 0x03
+META_TEMPO = 0x51
+META_END_OF_TRACK = 0x2F
+
+COPY_CHUNK = 1 << 16
+
+
+# Standard MIDI File -----------------------------------------------------------
+
+def variable_length(value):
+    """
+    A midi variable length quantity - 7 bits per byte, most significant first
+
+    >>> variable_length(0)
+    b'\\x00'
+    >>> variable_length(0x7F)
+    b'\\x7f'
+    >>> variable_length(0x80)
+    b'\\x81\\x00'
+    >>> variable_length(0x0FFFFFFF)
+    b'\\xff\\xff\\xff\\x7f'
+    """
+    data = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(data)
+
+
+def meta_event(meta_type, data=b''):
+    return bytes((0xFF, meta_type)) + variable_length(len(data)) + data
+
+
+class SmfWriter(object):
+    """
+    Write (timestamp_ns, track, status, data1, data2) messages to a format 1 Standard MIDI File.
+    Track 0 holds the tempo; player tracks are created as messages for them arrive.
+
+    >>> import io
+    >>> class Unclosed(io.BytesIO):
+    ...     def close(self):
+    ...         pass
+    >>> output = Unclosed()
+    >>> smf = SmfWriter(output, division=1000, tempo=60)  # 1 tick per ms
+    >>> smf.write(5000000, 0, 0x90, 60, 127)
+    >>> smf.write(9000000, 0, 0x90, 60, 0)
+    >>> smf.write(8000000, 0, 0xE0, 0, 64)  # Out of order - written at the previous tick
+    >>> smf.close()
+    >>> smf.messages, smf.duration
+    (3, 4000000)
+    >>> data = output.getvalue()
+    >>> data[:14] == SMF_HEADER.pack(b'MThd', 6, 1, 2, 1000)
+    True
+    >>> data[-16:].hex()
+    '00903c7f04903c0000e0004000ff2f00'
+    """
+    def __init__(self, filename, division=DEFAULT_DIVISION, tempo=DEFAULT_TEMPO, track_name='player{0}'):
+        self.filename = filename
+        self.division = division
+        self.tempo = 60000000 // tempo  # us per quarter note
+        self.ns_per_tick_division = self.tempo * 1000
+        self.track_name = track_name
+        self.tracks = {}  # track -> [temporary file, last tick]
+        self.start = None
+        self.end = None
+        self.messages = 0
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.messages else 0
+
+    def _track(self, track):
+        state = self.tracks.get(track)
+        if state is None:
+            filehandle = tempfile.TemporaryFile()
+            filehandle.write(variable_length(0) + meta_event(META_TRACK_NAME, self.track_name.format(track + 1).encode('ascii')))
+            state = self.tracks[track] = [filehandle, 0]
+        return state
+
+    def write(self, timestamp, track, status, data1, data2):
+        if self.start is None:
+            self.start = timestamp
+        self.end = max(timestamp, self.end or timestamp)
+        state = self._track(track)
+        tick = max(0, timestamp - self.start) * self.division // self.ns_per_tick_division
+        delta = max(0, tick - state[1])  # Messages out of timestamp order are written at the previous tick
+        state[0].write(variable_length(delta) + bytes((status, data1, data2)))
+        state[1] += delta
+        self.messages += 1
+
+    def _write_track(self, output, data, source=None):
+        end = variable_length(0) + meta_event(META_END_OF_TRACK)
+        length = len(data) + (source.tell() if source else 0) + len(end)
+        output.write(SMF_TRACK.pack(b'MTrk', length))
+        output.write(data)
+        if source:
+            source.seek(0)
+            shutil.copyfileobj(source, output, COPY_CHUNK)
+        output.write(end)
+
+    def close(self):
+        output = open(self.filename, 'wb') if isinstance(self.filename, str) else self.filename
+        try:
+            output.write(SMF_HEADER.pack(b'MThd', 6, SMF_FORMAT, len(self.tracks) + 1, self.division))
+            self._write_track(output, variable_length(0) + meta_event(META_TEMPO, self.tempo.to_bytes(3, 'big')))
+            for track in sorted(self.tracks):
+                self._write_track(output, b'', self.tracks[track][0])
+        finally:
+            output.close()
+            for filehandle, tick in self.tracks.values():
+                filehandle.close()
+
+
+# Sources ----------------------------------------------------------------------
+
+class _TrackOutput(object):
+    """
+    MidiBatch interface - stamps each message with the virtual clock and player track
+    """
+    def __init__(self, messages, clock, track):
+        self.messages = messages
+        self.clock = clock
+        self.track = track
+
+    def append(self, status, data1, data2):
+        self.messages.append((self.clock(), self.track, status, data1, data2))
+
+
+def _drain(messages):
+    yield from messages
+    messages.clear()
+
+
+def event_log_messages(filename, options):
+    """
+    Generator of (timestamp_ns, track, status, data1, data2) from replaying an event log through HeroInputs.
+    options are the pentatonic_hero.py options (get_args) the log was recorded with.
+    Timers (note sustain, pitch bend rate) fire at the virtual time they were due.
+    """
+    clock = ReplayClock(first_timestamp(filename))
+    scheduler = TimerScheduler(clock)
+    messages = []
+
+    input_profiles = options.input_profiles or (options.input_profile, options.input_profile2)
+    players = []
+    routes = {}
+    for index, input_profile in enumerate(input_profiles):
+        player = HeroInput(
+            input_profile,
+            MidiBatchOutput(_TrackOutput(messages, clock, index), (options.channel + index) % MIDI_CHANNELS),
+            clock=clock,
+            scheduler=scheduler,
+            input_identifyer=index + 1,
+            **vars(options)
+        )
+        players.append(player)
+        for source in getattr(input_profile, 'sources', ()):
+            routes.setdefault(source, []).append(player)
+    unrouted = [player for player in players if not hasattr(player.input_event_processor, 'sources')]
+    routes = {source: tuple(routed + unrouted) for source, routed in routes.items()}
+    input_filter = controls.InputFilter(input_profiles, options.drop_axes)
+
+    timestamp = 0
+    for timestamp, event in read_events(filename):
+        due = scheduler.next_due()
+        while due is not None and due <= timestamp:
+            clock.timestamp = due
+            scheduler.run_due()
+            due = scheduler.next_due()
+        yield from _drain(messages)
+        clock.timestamp = timestamp
+        if input_filter(event):
+            for player in routes.get(controls.event_source(event), unrouted):
+                if player.update_state(event):
+                    player.process_state()
+            yield from _drain(messages)
+
+    # Let sustained notes finish, then leave nothing ringing
+    due = scheduler.next_due()
+    while due is not None:
+        clock.timestamp = timestamp = max(timestamp, due)
+        scheduler.run_due()
+        due = scheduler.next_due()
+    for player in players:
+        player._send_note_off()
+    yield from _drain(messages)
+
+
+def display_dump_messages(filename, options):
+    """
+    Generator of (timestamp_ns, track, status, data1, data2) from a json lines dump of display events.
+    The midi is rebuilt from the note_on, note_off and pitch events; each input is a track on channel --channel + input - 1.
+    """
+    timestamp = 0
+    clock = lambda: timestamp
+    messages = []
+    outputs = {}
+
+    def output(input):
+        if input not in outputs:
+            outputs[input] = MidiBatchOutput(_TrackOutput(messages, clock, input - 1), (options.channel + input - 1) % MIDI_CHANNELS)
+        return outputs[input]
+
+    with open(filename, 'r') as filehandle:
+        for line in filehandle:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            for message in (data if isinstance(data, list) else (data, )):
+                events = display_codec.unpack(message['data']) if message.get('event') == display_codec.EVENT_PACKED else (message, )
+                for event in events:
+                    if 'timestamp' in event:
+                        timestamp = int(event['timestamp'] * 1000000)
+                    name = event.get('event')
+                    if name == 'note_on':
+                        output(event['input']).note(event['value'], event.get('velocity', 1.0))
+                    elif name == 'note_off':
+                        output(event['input']).note(event['value'], 0)
+                    elif name == 'pitch':
+                        output(event['input']).pitch(event['pitch'])
+                    yield from _drain(messages)
+
+
+def is_event_log(filename):
+    with open(filename, 'rb') as filehandle:
+        return filehandle.read(len(HEADER))[:4] == HEADER[:4]  # Any version - read_events rejects older ones
+
+
+def recording_messages(filename, options):
+    return (event_log_messages if is_event_log(filename) else display_dump_messages)(filename, options)
+
+
+# Render -----------------------------------------------------------------------
+
+def render(filename, output_filename, options, division=DEFAULT_DIVISION, tempo=DEFAULT_TEMPO):
+    """
+    Render one recording to a midi file. Returns (messages, duration_ns)
+    """
+    smf = SmfWriter(output_filename, division=division, tempo=tempo)
+    for message in recording_messages(filename, options):
+        smf.write(*message)
+    smf.close()
+    return smf.messages, smf.duration
+
+
+def _render_file(filename, output_filename, argv, division, tempo):
+    """
+    Process pool entry point - options are parsed in the worker as input profiles cannot be pickled
+    """
+    return render(filename, output_filename, get_args(argv), division, tempo)
+
+
+def render_directory(directory, output_directory=None, argv=(), workers=None, division=DEFAULT_DIVISION, tempo=DEFAULT_TEMPO):
+    """
+    Render every recording in a directory in a pool of worker processes.
+    Generator of (filename, output filename, (messages, duration_ns) or the exception raised)
+    """
+    output_directory = output_directory or directory
+    os.makedirs(output_directory, exist_ok=True)
+    filenames = [
+        os.path.join(directory, filename)
+        for filename in sorted(os.listdir(directory))
+        if not filename.endswith(MIDI_EXTENSION) and os.path.isfile(os.path.join(directory, filename))
+    ]
+    with ProcessPoolExecutor(workers) as executor:
+        futures = []
+        for filename in filenames:
+            output_filename = os.path.join(output_directory, os.path.splitext(os.path.basename(filename))[0] + MIDI_EXTENSION)
+            futures.append((filename, output_filename, executor.submit(_render_file, filename, output_filename, list(argv), division, tempo)))
+        for filename, output_filename, future in futures:
+            try:
+                yield filename, output_filename, future.result()
+            except Exception as ex:
+                yield filename, output_filename, ex
+
+
+# Main -------------------------------------------------------------------------
+
+def get_render_args():
+    """
+    Command line argument handling - options after -- are passed to pentatonic_hero.get_args
+    """
+    import sys
+    import argparse
+
+    argv = sys.argv[1:]
+    player_argv = []
+    if '--' in argv:
+        player_argv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(
+        prog='midi_render',
+        description="""Pentetonic Hero -
+        Render recorded input event logs or display event dumps to Standard MIDI Files
+        """,
+        epilog="""Options after -- are the pentatonic_hero.py options the recording was made with""",
+    )
+    parser.add_argument('recordings', nargs='*', help='Event logs (--record) or json lines display event dumps')
+    parser.add_argument('-o', '--output', action='store', help='Output midi file (single recording) or directory', default=None)
+    parser.add_argument('--directory', action='store', help='Render every recording in this directory', default=None)
+    parser.add_argument('--workers', action='store', type=int, help='Worker processes for --directory (default one per cpu)', default=None)
+    parser.add_argument('--division', action='store', type=int, help='Ticks per quarter note', default=DEFAULT_DIVISION)
+    parser.add_argument('--tempo', action='store', type=int, help='Tempo (bpm) of the midi file - sets the length of a tick', default=DEFAULT_TEMPO)
+    parser.add_argument('--log_level', type=int, help='log level', default=logging.INFO)
+
+    args = parser.parse_args(argv)
+    if not args.recordings and not args.directory:
+        parser.error('a recording or --directory is required')
+    args.player_argv = player_argv
+    return args
+
+
+def _log_result(filename, output_filename, result):
+    if isinstance(result, Exception):
+        log.error('{0}: {1}'.format(filename, result))
+    else:
+        messages, duration = result
+        log.info('{0} -> {1}: {2} midi messages, {3:.1f}s'.format(filename, output_filename, messages, duration / 1000000000))
+
+
+if __name__ == "__main__":
+    args = get_render_args()
+    logging.basicConfig(level=args.log_level)
+    if args.directory:
+        for result in render_directory(args.directory, args.output, args.player_argv, args.workers, args.division, args.tempo):
+            _log_result(*result)
+    options = get_args(args.player_argv)
+    for filename in args.recordings:
+        if args.output and len(args.recordings) == 1 and not os.path.isdir(args.output):
+            output_filename = args.output
+        else:
+            output_filename = os.path.join(args.output or os.path.dirname(filename), os.path.splitext(os.path.basename(filename))[0] + MIDI_EXTENSION)
+        _log_result(filename, output_filename, render(filename, output_filename, options, args.division, args.tempo))
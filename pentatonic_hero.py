@@ -1,14 +1,29 @@
 #!/usr/local/bin/python3
+import os
 import pygame
-import datetime
+import time
+import signal
+import cProfile
 import operator
 from collections import namedtuple
 
-from libs.music import note_to_text, parse_note, SCALES
 from libs.pygame_midi_wrapper import PygameMidiDeviceHelper
 from libs.pygame_midi_output import PygameMidiOutputWrapper
 from libs.client_reconnect import SubscriptionClient, SocketReconnectNull
 import controls
+from latency import LatencyMonitor, PlayerLatencyNull, StartupTimer, clock_ns
+from metrics import PlayerMetrics, log_metrics
+from display_queue import DisplayEventQueue, DROP_POLICIES, DEFAULT_QUEUE_SIZE
+import display_codec
+from display_hub import DisplayHub, DEFAULT_MAX_BUFFER as DEFAULT_DISPLAY_HUB_CLIENT_BUFFER
+from hotplug import JoystickSlots, HOTPLUG_EVENTS
+from state_feed import StateFeedWriter, STATE_FEED_ENVIRONMENT_VARIABLE
+from event_log import EventRecorder, ReplayClock, read_events, first_timestamp
+from scheduler import TimerScheduler
+from async_runtime import AsyncRuntime, DEFAULT_POLL_INTERVAL
+from sharding import InputShards, group_players, PLAYER_OPTIONS as SHARD_PLAYER_OPTIONS, DEFAULT_RING_SIZE as DEFAULT_SHARD_RING_SIZE
+import trace_buffer
+from midi_batch import MidiBatch, MidiBatchOutput, open_output, MODES as MIDI_OUTPUT_MODES, MODE_DIRECT, MODE_IMMEDIATE, MODE_SCHEDULED, DEFAULT_LATENCY as DEFAULT_MIDI_LATENCY
 
 import logging
 log = logging.getLogger(__name__)
@@ -26,66 +41,203 @@ DEFAULT_ROOT_NOTE = 'A3'
 DEFAULT_SCALE = 'pentatonic_minor'
 DEFAULT_HAMMER_DECAY = -0.05
 DEFAULT_HAMMER_STRUM_BLOCK_DELAY = 50
-DEFAULT_NOTE_LIMIT = (parse_note('C1'), parse_note('C#5'))
+DEFAULT_NOTE_LIMIT = ('C1', 'C#5')
+DEFAULT_PITCH_BEND_RESOLUTION = 14  # bits - full midi pitch bend resolution
+DEFAULT_PITCH_BEND_DEADBAND = 0.0
+DEFAULT_PITCH_BEND_RATE = 0  # max pitch messages per second per player (0 is unlimited)
+DEFAULT_NOTE_SUSTAIN = 0  # ms a note rings for before being released (0 rings until the buttons are released)
 EVENT_DISPLAY_FUNCTION_NAME = 'pentatonic_hero.event'
 EVENT_CONTROL_MUTE_FUNCTION_NAME = 'pentatonic_hero.control.mute'
-
-now = lambda: datetime.datetime.now()
+EVENT_CONTROL_PROFILE_FUNCTION_NAME = 'pentatonic_hero.control.profile'
+EVENT_LATENCY_FUNCTION_NAME = 'pentatonic_hero.latency'
+EVENT_METRICS_FUNCTION_NAME = 'pentatonic_hero.metrics'
+DEFAULT_PROFILE_FILE = 'pentatonic_hero.prof'
 
 NoteLimit = namedtuple('NoteLimit', ['lower', 'upper'])
 
+RUNTIME_PYGAME = 'pygame'
+RUNTIME_ASYNCIO = 'asyncio'
+RUNTIMES = (RUNTIME_PYGAME, RUNTIME_ASYNCIO)
+
+MIDI_CHANNELS = 16
+TRACE_DUMP_KEY = pygame.K_PRINT
+PROFILE_KEY = pygame.K_PAUSE
+MUTE_KEYS = (
+    pygame.K_F1, pygame.K_F2, pygame.K_F3, pygame.K_F4, pygame.K_F5, pygame.K_F6,
+    pygame.K_F7, pygame.K_F8, pygame.K_F9, pygame.K_F10, pygame.K_F11, pygame.K_F12,
+)
+
+# Note Tables ------------------------------------------------------------------
+
+NUMBER_OF_BUTTONS = 5
+BUTTON_MASK_ALL = (1 << NUMBER_OF_BUTTONS) - 1
+BUTTON_BITS = tuple(1 << index for index in range(NUMBER_OF_BUTTONS))
+# The index of the highest pressed button for every possible button bitmask (-1 when nothing is pressed)
+BUTTON_GREATEST = tuple(mask.bit_length() - 1 for mask in range(1 << NUMBER_OF_BUTTONS))
+
+_note_text_cache = {}
+_scale_limit_cache = {}
+
+
+def music():
+    """
+    libs.music builds its note and scale tables when imported.
+    It is imported on first use so startup does not pay for it before the players are created.
+    """
+    import libs.music
+    return libs.music
+
+
+def parse_note(note):
+    """
+    Note names (e.g. 'A3') to midi note numbers - midi note numbers are passed through
+    """
+    return music().parse_note(note) if isinstance(note, str) else note
+
+
+def parse_scale(scale):
+    """
+    Scale names (defined in music.py) to scales - scales are passed through
+    """
+    if not isinstance(scale, str):
+        return scale
+    scales = music().SCALES
+    if scale not in scales:
+        raise ValueError('unknown scale {0} - choose from {1}'.format(scale, sorted(scales.keys())))
+    return scales[scale]
+
+
+def note_text(note):
+    """
+    Cached note_to_text - the same handful of labels are requested on every transpose
+    """
+    try:
+        return _note_text_cache[note]
+    except KeyError:
+        _note_text_cache[note] = text = music().note_to_text(note)
+        return text
+
+
+def scale_index_offset_limit(scale, root_note, note_limit, number_of_buttons=NUMBER_OF_BUTTONS):
+    """
+    The lowest and highest scale_index_offset that keep every button within note_limit.
+
+    The limit only depends on the distance between the root_note and the note_limit,
+    so results are cached per scale and relative range.
+    """
+    key = (scale, note_limit.lower - root_note, note_limit.upper - root_note, number_of_buttons)
+    try:
+        return _scale_limit_cache[key]
+    except KeyError:
+        pass
+
+    def _nearest_scale_index_offset(target_midi_note, index_offset, seek_direction):
+        """
+        seek_direction -1 or +1
+        """
+        if seek_direction != 1 and seek_direction != -1:
+            raise AttributeError('seek_drieciton muse be 1 or -1')
+        scale_index_offset = 0
+        compare = operator.ge if seek_direction == 1 else operator.le
+        while compare(target_midi_note, root_note + scale.scale_note(scale_index_offset + index_offset)):
+            scale_index_offset += seek_direction
+        # When we pop out of the desitred range, revert the last seek_direction
+        # to ensure last note (scale_index) is definantly within out range
+        return scale_index_offset - seek_direction
+    _scale_limit_cache[key] = limit = NoteLimit(
+        lower=_nearest_scale_index_offset(note_limit.lower, 0                    , -1),
+        upper=_nearest_scale_index_offset(note_limit.upper, number_of_buttons - 1,  1),
+    )
+    return limit
+
+
 # Input Logic & State  ---------------------------------------------------------
 
 
 class HeroInput(object):
-    NUMBER_OF_BUTTONS = 5
+    NUMBER_OF_BUTTONS = NUMBER_OF_BUTTONS
 
     input_identifyer = 0
 
     def __init__(self, input_event_processor, midi_output,
         display=SocketReconnectNull(),
-        root_note=parse_note(DEFAULT_ROOT_NOTE),
-        scale=SCALES[DEFAULT_SCALE],
+        root_note=DEFAULT_ROOT_NOTE,
+        scale=DEFAULT_SCALE,
         hammer_ons=True,
         hammer_decay=DEFAULT_HAMMER_DECAY,
         hammer_strum_block_delay=DEFAULT_HAMMER_STRUM_BLOCK_DELAY,
-        note_limit=NoteLimit(*DEFAULT_NOTE_LIMIT),
+        note_limit=DEFAULT_NOTE_LIMIT,
+        pitch_bend_resolution=DEFAULT_PITCH_BEND_RESOLUTION,
+        pitch_bend_deadband=DEFAULT_PITCH_BEND_DEADBAND,
+        pitch_bend_rate=DEFAULT_PITCH_BEND_RATE,
+        note_sustain=DEFAULT_NOTE_SUSTAIN,
+        latency=None,
+        trace=None,
+        clock=clock_ns,
+        scheduler=None,
+        input_identifyer=None,
         **kwargs
     ):
         HeroInput.input_identifyer += 1
-        self.input_identifyer = HeroInput.input_identifyer
+        self.input_identifyer = input_identifyer or HeroInput.input_identifyer
 
         self.input_event_processor = input_event_processor
 
+        # Note and scale names are resolved here so libs.music is only loaded once a player is created
+        root_note = parse_note(root_note)
+        scale = parse_scale(scale)
+        note_limit = NoteLimit(*map(parse_note, note_limit))
+
         self.root_note = root_note
         assert root_note >= note_limit.lower and root_note <= note_limit.upper, 'root_note is not within note range limit'
 
         self.scale = scale
         self.midi_output = midi_output
+        self.latency = latency or PlayerLatencyNull()
+        self.clock = clock  # monotonic ns - replaced with the event timestamps when replaying
+        self.trace = trace
+        self.scheduler = scheduler  # Optional TimerScheduler for sustain release and pitch bend flushing
+        self.metrics = PlayerMetrics()
+
+        self.display_packed = False  # Send compact display_codec records rather than json dicts
 
         def display_event(event, **kwargs):
+            if self.display_packed and event in display_codec.OPCODES:
+                display.send_message(display_codec.record(event, self.input_identifyer, self.clock(), **kwargs))
+                return
             kwargs['event'] = event
             kwargs['input'] = self.input_identifyer
+            kwargs['timestamp'] = self.clock() // 1000000  # ms, as packed events
             kwargs['func'] = EVENT_DISPLAY_FUNCTION_NAME
             display.send_message(kwargs)
         self.display_event = display_event
 
         self.hammer_decay = hammer_decay
         self.enable_hammer_ons_and_pulloffs = hammer_ons
-        self.hammer_strum_block_delay = datetime.timedelta(microseconds=hammer_strum_block_delay * 1000)
+        self.hammer_strum_block_delay = hammer_strum_block_delay * 1000000
         self.note_limit = note_limit
 
-        self.button_states = [False] * self.NUMBER_OF_BUTTONS
+        self.button_mask = 0
         self.playing_power = 0
         self.previous_note = 0
-        self.previous_note_timestamp = now()
+        self.previous_note_timestamp = clock()
         self.pitch_bend = 0
         self.previous_pitch_bend = 0
+        self.pitch_bend_steps = 1 << (pitch_bend_resolution - 1)
+        self.pitch_bend_deadband = pitch_bend_deadband
+        self.pitch_bend_interval = int(1000000000 / pitch_bend_rate) if pitch_bend_rate else 0
+        self.pitch_bend_timestamp = 0
+        self.pitch_bend_pending = False
+        self._pitch_bend_timer = None
+
+        self.note_sustain = note_sustain * 1000000
+        self._release_timer = None
 
         self.mute = False
 
         self.scale_index_offset = 0
         self._calculate_scale_limit()
+        self._build_note_table()
 
         # A dictionary of bound methods to manipulate this HeroInput
         # The controler code can call these to update to the state
@@ -102,35 +254,32 @@ class HeroInput(object):
         }
 
     def _calculate_scale_limit(self):
-        def _nearest_scale_index_offset(target_midi_note, index_offset, seek_direction):
-            """
-            seek_direction -1 or +1
-            """
-            if seek_direction != 1 and seek_direction != -1:
-                raise AttributeError('seek_drieciton muse be 1 or -1')
-            scale_index_offset = 0
-            compare = operator.ge if seek_direction == 1 else operator.le
-            while compare(target_midi_note, self.get_midi_note(scale_index_offset + index_offset)):
-                scale_index_offset += seek_direction
-            # When we pop out of the desitred range, revert the last seek_direction
-            # to ensure last note (scale_index) is definantly within out range
-            return scale_index_offset - seek_direction
-        self.scale_index_offset_limit = NoteLimit(
-            lower=_nearest_scale_index_offset(self.note_limit.lower, 0                        , -1),
-            upper=_nearest_scale_index_offset(self.note_limit.upper, len(self.button_states)-1,  1),
-        )
+        self.scale_index_offset_limit = scale_index_offset_limit(self.scale, self.root_note, self.note_limit, self.NUMBER_OF_BUTTONS)
+
+    def _build_note_table(self):
+        """
+        Precompute the midi note for every button bitmask.
+        Only needs rebuilding when the root_note or scale_index_offset change.
+        """
+        button_notes = tuple(self.get_midi_note(index) for index in range(self.NUMBER_OF_BUTTONS))
+        self._note_table = tuple(button_notes[greatest] if greatest >= 0 else None for greatest in BUTTON_GREATEST)
+        self._note_labels = tuple(note_text(note) for note in button_notes)
+
+    @property
+    def button_states(self):
+        return [bool(self.button_mask & bit) for bit in BUTTON_BITS]
 
     @property
     def button_greatest(self):
-        return max([-1] + [index for index, state in enumerate(self.button_states) if state])
+        return BUTTON_GREATEST[self.button_mask]
 
     @property
     def button_all(self):
-        return not any([not b for b in self.button_states])
+        return self.button_mask == BUTTON_MASK_ALL
 
     @property
     def current_midi_note(self):
-        return self.get_midi_note(self.button_greatest)
+        return self._note_table[self.button_mask]
 
     def get_midi_note(self, scale_index):
         return self.root_note + self.scale.scale_note(scale_index + self.scale_index_offset)
@@ -140,15 +289,19 @@ class HeroInput(object):
         if (proposed_scale_index_offset >= self.scale_index_offset_limit.lower) and \
            (proposed_scale_index_offset <= self.scale_index_offset_limit.upper):
             self.scale_index_offset = proposed_scale_index_offset
+            self._build_note_table()
+            self.metrics.transposes += 1
             log.info('scale transpose: {0}'.format(offset))
-            self.display_event('transpose', notes=[note_to_text(self.get_midi_note(i)) for i, _ in enumerate(self.button_states)])
+            self.display_event('transpose', notes=list(self._note_labels))
         else:
             log.info('scale transpose: restricted with limit')
 
     def transpose_root(self, offset):
         self.root_note += offset
-        log.info('root note: {0}'.format(note_to_text(self.root_note)))
+        self.metrics.transposes += 1
+        log.info('root note: {0}'.format(note_text(self.root_note)))
         self._calculate_scale_limit()
+        self._build_note_table()
 
     # Input Logic ----------------------------
 
@@ -165,11 +318,11 @@ class HeroInput(object):
             self.transpose_scale(-1)
 
     def ctrl_note_up(self, index):
-        self.button_states[index] = False
+        self.button_mask &= ~BUTTON_BITS[index]
         self.display_event('button_up', button=index)
 
     def ctrl_note_down(self, index):
-        self.button_states[index] = True
+        self.button_mask |= BUTTON_BITS[index]
         self.display_event('button_down', button=index)
 
     def ctrl_strum(self, value=None):
@@ -181,10 +334,19 @@ class HeroInput(object):
         if value is None or value > 0.1 or value < -0.1:
             value = value or 0
             self.playing_power = 1
+            self.metrics.strums += 1
+            if self.trace:
+                self.trace.record(trace_buffer.STRUM, self.input_identifyer, 0, 1 if value >= 0 else -1)
             self.display_event('strum', value=1 if value >= 0 else -1)
 
     def ctrl_pitch_bend(self, value):
-        self.pitch_bend = value
+        """
+        Quantise to pitch_bend_resolution bits and snap to center within the deadband
+        """
+        value = round(value * self.pitch_bend_steps) / self.pitch_bend_steps
+        if -self.pitch_bend_deadband < value < self.pitch_bend_deadband:
+            value = 0
+        self.pitch_bend = max(-1, min(1, value))
 
     # Events -------------------------------------
 
@@ -195,9 +357,15 @@ class HeroInput(object):
         if mute is None:
             mute = not self.mute  # Toggle exisiting state if no state provided
         log.info('input{0} mute: {1}'.format(self.input_identifyer, mute))
+        if mute != self.mute:
+            self.metrics.mutes += 1
+        if self.trace:
+            self.trace.record(trace_buffer.MUTE, self.input_identifyer, 0, mute)
         if mute:
             self._send_note_off()
             self._send_pitch_bend(0)
+            self.previous_pitch_bend = 0
+            self.pitch_bend_pending = False
         self.mute = mute
 
     def update_state(self, event):
@@ -209,99 +377,320 @@ class HeroInput(object):
           the note buttons shift in the scale being used (by default the pentatonic)
         If all the note buttons are pressed and the TRANSPOSE buttons are used:
           the starting note (the music key) is changed
+
+        Returns True if the event was consumed by this input
         """
-        self.input_event_processor(event, self.control_methods)
+        if self.input_event_processor(event, self.control_methods):
+            self.latency.mark_processed()
+            return True
+        return False
 
     def process_state(self):
         # Stop playing note if none pressed
-        if self.button_greatest == -1:
+        button_mask = self.button_mask
+        if not button_mask:
             self.playing_power = 0
             self._send_note_off()
         if self.playing_power > 0:
-            current_note = self.current_midi_note
+            current_note = self._note_table[button_mask]
             # Do not play a strum if the note has not chaged since a recent hammer on
             if (
                 self.hammer_strum_block_delay and
                 self.playing_power >= 1 and
                 self.previous_note == current_note and
-                now() - self.previous_note_timestamp < self.hammer_strum_block_delay
+                self.clock() - self.previous_note_timestamp < self.hammer_strum_block_delay
             ):
                 log.debug('hammer_strum_block_delay')
+                self.metrics.blocked_strums += 1
                 self.playing_power += self.hammer_decay
             # Play if note changed or strum
             elif current_note != self.previous_note or self.playing_power >= 1:
                 self._send_note(current_note)
                 self.playing_power += self.hammer_decay
         if self.pitch_bend != self.previous_pitch_bend:
-            self.previous_pitch_bend = self.pitch_bend
-            self._send_pitch_bend(self.pitch_bend)
-            self.display_event('pitch', pitch=self.pitch_bend)
+            self.flush_pitch_bend()
+
+    def flush_pitch_bend(self):
+        """
+        Send the current pitch bend unless the pitch_bend_rate limit has been reached.
+        A limited value is left pending and flushed by a timer, so the bend always lands on its final value.
+        """
+        if self.pitch_bend == self.previous_pitch_bend:
+            self.pitch_bend_pending = False
+            return
+        if self.pitch_bend_interval:
+            timestamp = self.clock()
+            if timestamp - self.pitch_bend_timestamp < self.pitch_bend_interval:
+                self.pitch_bend_pending = True
+                if self.scheduler and not self._pitch_bend_timer:
+                    self._pitch_bend_timer = self.scheduler.schedule_at(self.pitch_bend_timestamp + self.pitch_bend_interval, self._pitch_bend_timer_due)
+                return
+            self.pitch_bend_timestamp = timestamp
+        self.pitch_bend_pending = False
+        self.previous_pitch_bend = self.pitch_bend
+        self._send_pitch_bend(self.pitch_bend)
+        self.display_event('pitch', pitch=self.pitch_bend)
+
+    def _pitch_bend_timer_due(self):
+        self._pitch_bend_timer = None
+        self.flush_pitch_bend()
+
+    def release_note(self):
+        """
+        Stop the ringing note (the note_sustain timer)
+        """
+        self._release_timer = None
+        self.playing_power = 0
+        self._send_note_off()
+
+    def release_all(self):
+        """
+        Release every button, the ringing note and any pitch bend - e.g. when the controller is unplugged
+        """
+        for index, bit in enumerate(BUTTON_BITS):
+            if self.button_mask & bit:
+                self.ctrl_note_up(index)
+        self.playing_power = 0
+        self._send_note_off()
+        self.pitch_bend = 0
+        self.pitch_bend_pending = False
+        if self.previous_pitch_bend:
+            self.previous_pitch_bend = 0
+            self._send_pitch_bend(0)
+            self.display_event('pitch', pitch=0)
 
     def _send_note(self, note):
         if not note:
             return
+        previous_note = self.previous_note
         self._send_note_off()
         self.previous_note = note
         if note and not self.mute:
             if self.playing_power == 1 or \
                self.playing_power < 1 and self.enable_hammer_ons_and_pulloffs:
                 self.midi_output.note(note, self.playing_power)
-                self.display_event('note_on', value=note, button=self.button_greatest)
-                self.previous_note_timestamp = now()
+                self.latency.mark_midi()
+                metrics = self.metrics
+                metrics.notes += 1
+                metrics.midi_messages += 1
+                if self.playing_power < 1 and previous_note:
+                    if note > previous_note:
+                        metrics.hammer_ons += 1
+                    else:
+                        metrics.pull_offs += 1
+                if self.trace:
+                    self.trace.record(trace_buffer.NOTE_ON, self.input_identifyer, note, self.playing_power)
+                self.display_event('note_on', value=note, button=self.button_greatest, velocity=self.playing_power)
+                self.previous_note_timestamp = self.clock()
+                if self.note_sustain and self.scheduler:
+                    self.scheduler.cancel(self._release_timer)
+                    self._release_timer = self.scheduler.schedule(self.note_sustain, self.release_note)
 
     def _send_note_off(self):
+        if self._release_timer:
+            self.scheduler.cancel(self._release_timer)
+            self._release_timer = None
         if self.previous_note and not self.mute:
             self.midi_output.note(self.previous_note, velocity=0)
+            self.metrics.midi_messages += 1
+            if self.trace:
+                self.trace.record(trace_buffer.NOTE_OFF, self.input_identifyer, self.previous_note)
             self.display_event('note_off', value=self.previous_note)
             self.previous_note = None
 
     def _send_pitch_bend(self, pitch):
         if not self.mute:
             self.midi_output.pitch(pitch)
+            self.metrics.midi_messages += 1
+            if self.trace:
+                self.trace.record(trace_buffer.PITCH, self.input_identifyer, 0, pitch)
 
 
 # Pygame -----------------------------------------------------------------------
 
 class App:
     def __init__(self, options):
-        pygame.init()
-        pygame.display.set_caption(TITLE)
+        self.startup = StartupTimer()
+        input_profiles = options.input_profiles or (options.input_profile, options.input_profile2)
+
+        # Init pygame
+        if options.headless:
+            # No window - the dummy video driver still provides the event queue
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            if any(controls.KEYBOARD in getattr(input_profile, 'sources', ()) for input_profile in input_profiles):
+                log.warning('headless: keyboard input profiles will not receive key events')
+        if options.fast_start:
+            # Only the video subsystem (it owns the event queue) - joysticks and midi are initialised below if needed
+            pygame.display.init()
+        else:
+            pygame.init()
+        if not options.headless:
+            pygame.display.set_caption(TITLE)
         pygame.event.set_blocked(pygame.MOUSEMOTION)
+        self.startup.phase('pygame')
 
         #self.clock = pygame.time.Clock()
-        pygame.fastevent.init()
-        self.wait_input = pygame.fastevent.wait
-        #self.wait_input = pygame.event.wait
-
-        # Init joysticks
-        pygame.joystick.init()
-        self.joysticks = {}
-        for joystick in map(pygame.joystick.Joystick, range(0, pygame.joystick.get_count())):
-            self.joysticks[joystick.get_name()] = joystick
-            joystick.init()
+        self.wait_input = pygame.event.wait
+
+        # Event recording/replay
+        self.clock = ReplayClock(first_timestamp(options.replay)) if options.replay else clock_ns
+        self.recorder = EventRecorder(options.record) if options.record else None
+
+        # Timers - the main loop waits for input until the next timer is due
+        self.scheduler = TimerScheduler(self.clock)
+
+        # Hot path tracing
+        self.trace = trace_buffer.TraceBuffer(options.trace_size) if options.trace_size else None
+        self.trace_file = options.trace_file
+        if self.trace and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.trace.dump(self.trace_file))
+
+        # Input sharding - groups of joystick only players run in worker processes
+        shard_groups = group_players(input_profiles, options.input_shards) if options.input_shards else ()
+        sharded = {index for group in shard_groups for index in group}
+        local_profiles = [input_profile for index, input_profile in enumerate(input_profiles) if index not in sharded]
+
+        # Init joysticks - the workers open their own
+        joystick_numbers = self._profile_joysticks(local_profiles) if options.fast_start or sharded else None
+        self.joystick_slots = JoystickSlots(joystick_numbers, self.clock, bind_new=not sharded)
+        if joystick_numbers is None or joystick_numbers:
+            pygame.joystick.init()
+            joystick_count = pygame.joystick.get_count()
+            if joystick_numbers is None:
+                joystick_numbers = range(0, joystick_count)
+            for joystick_number in sorted(joystick_numbers):
+                if joystick_number >= joystick_count:
+                    log.warning('joystick {0} is not connected'.format(joystick_number))
+                    continue
+                self.joystick_slots.bind(joystick_number, pygame.joystick.Joystick(joystick_number))
+        self.startup.phase('joysticks')
 
         # Init midi
         pygame.midi.init()
-        self.midi_out = PygameMidiDeviceHelper.open_device(options.midi_port_name)
+        if options.midi_output_mode == MODE_SCHEDULED:
+            self.midi_out = open_output(options.midi_port_name, latency=options.midi_latency)
+        else:
+            self.midi_out = PygameMidiDeviceHelper.open_device(options.midi_port_name)
+        self.midi_batch = MidiBatch(self.midi_out, scheduled=options.midi_output_mode == MODE_SCHEDULED) if options.midi_output_mode != MODE_DIRECT else None
+        self.startup.phase('midi')
 
         # Network display reporting
-        self.display = SubscriptionClient(*options.display_host.split(':'), subscriptions=(EVENT_CONTROL_MUTE_FUNCTION_NAME,))
+        if options.display_hub:
+            # Serve display clients directly - tcp on the display host port, websocket on the next
+            host, port = options.display_host.split(':')
+            # Records are converted to each client's format by the hub
+            self.display = DisplayHub(host, int(port), int(port) + 1, options.display_hub_client_buffer, options.display_format)
+            output_display = self.display
+            display_packed = options.display_format != display_codec.FORMAT_JSON
+        else:
+            # The display server relays to every subscriber, so auto stays json for displays that cannot unpack
+            self.display = SubscriptionClient(*options.display_host.split(':'), subscriptions=(EVENT_CONTROL_MUTE_FUNCTION_NAME, EVENT_CONTROL_PROFILE_FUNCTION_NAME))
+            output_display = display_codec.PackedDisplay(self.display)
+            display_packed = options.display_format == display_codec.FORMAT_PACKED
         self.display.recive_message = self.control_command
-
-        self.players = {
-            'player1': HeroInput(
-                options.input_profile,
-                PygameMidiOutputWrapper.factory(self.midi_out, channel=options.channel),
-                display=self.display,
-                **vars(options)
-            ),
-            'player2': HeroInput(
-                options.input_profile2,
-                PygameMidiOutputWrapper.factory(self.midi_out, channel=options.channel+1),
-                display=self.display,
+        # The asyncio runtime always queues display events so socket sends never block the loop
+        display_queue_size = options.display_queue_size or (DEFAULT_QUEUE_SIZE if options.runtime == RUNTIME_ASYNCIO else 0)
+        self.display_queue = DisplayEventQueue(output_display, display_queue_size, options.display_drop_policy, threaded=options.runtime != RUNTIME_ASYNCIO) if display_queue_size else None
+        display = self.display_queue or output_display
+        self.startup.phase('display')
+
+        # Latency instrumentation
+        self.latency = LatencyMonitor(batched=bool(self.midi_batch)) if options.latency_report_interval else None
+        self.latency_report_interval = int(options.latency_report_interval * 1000000000)
+        if self.latency:
+            self.scheduler.schedule(self.latency_report_interval, self.report_latency)
+            if self.midi_batch:
+                self.midi_batch.written = self.latency.midi_written
+
+        # Metrics and on demand profiling
+        self.metrics_report_interval = int(options.metrics_report_interval * 1000000000)
+        if self.metrics_report_interval:
+            self.scheduler.schedule(self.metrics_report_interval, self.report_metrics)
+        self.profiler = None
+        self.profile_file = options.profile_file
+
+        # Note and scale tables
+        music()
+        self.startup.phase('music')
+
+        # Players - each on their own midi channel
+        if len(input_profiles) > MIDI_CHANNELS:
+            log.warning('{0} players share {1} midi channels'.format(len(input_profiles), MIDI_CHANNELS))
+        names = ['player{0}'.format(index + 1) for index in range(len(input_profiles))]
+        channels = [(options.channel + index) % MIDI_CHANNELS for index in range(len(input_profiles))]
+        self.shards = None
+        self.shard_poll_interval = options.poll_interval * 1000000
+        if shard_groups:
+            self.shards = InputShards(
+                [
+                    [(index + 1, names[index], input_profiles[index].name, input_profiles[index].definition, channels[index]) for index in group]
+                    for group in shard_groups
+                ],
+                {key: getattr(options, key) for key in SHARD_PLAYER_OPTIONS},
+                self.midi_batch or MidiBatch(self.midi_out),
+                display,  # Through the display queue like the players in this process
+                drop_axes=options.drop_axes,
+                ring_size=options.shard_ring_size,
+                log_level=options.log_level,
+            )
+            self.scheduler.schedule(0, self.poll_shards)
+        self.players = {}
+        for index, input_profile in enumerate(input_profiles):
+            name = names[index]
+            if index in sharded:
+                self.players[name] = self.shards.players[name]
+                continue
+            self.players[name] = HeroInput(
+                input_profile,
+                self._midi_output(channels[index]),
+                display=display,
+                latency=self.latency.player(name) if self.latency else None,
+                trace=self.trace,
+                clock=self.clock,
+                scheduler=self.scheduler,
+                input_identifyer=index + 1,
                 **vars(options)
-            ),
-        }
+            )
+        self._build_routes()
+        self.input_filter = controls.InputFilter(local_profiles, options.drop_axes)
+        self.state_feed = StateFeedWriter(options.state_feed, len(self.players)) if options.state_feed else None
+        self.state_feed_players = tuple(self.players.values())
+        self.publish_state()
+        self.set_display_packed(display_packed)
+        self.startup.phase('players')
+        log.info('startup: {0}'.format(self.startup.summary()))
+
+    @staticmethod
+    def _profile_joysticks(input_profiles):
+        """
+        The joystick numbers read by the input profiles (None if any profile does not declare them)
+        """
+        joystick_numbers = set()
+        for input_profile in input_profiles:
+            if not hasattr(input_profile, 'joysticks'):
+                return None
+            joystick_numbers |= input_profile.joysticks
+        return joystick_numbers
+
+    def _midi_output(self, channel):
+        if self.midi_batch:
+            return MidiBatchOutput(self.midi_batch, channel=channel)
+        return PygameMidiOutputWrapper.factory(self.midi_out, channel=channel)
+
+    def _build_routes(self):
+        """
+        Index the players by the input sources (joy number or keyboard) their input profiles read,
+        so each event is only passed to the players that own it.
+        Players with input processors that do not declare their sources receive every event.
+        """
+        unrouted = tuple(player for player in self.players.values() if not hasattr(player.input_event_processor, 'sources'))
+        routes = {}
+        for player in self.players.values():
+            for source in getattr(player.input_event_processor, 'sources', ()):
+                routes.setdefault(source, []).append(player)
+        self.routes = {source: tuple(players) + unrouted for source, players in routes.items()}
+        self.routes_unrouted = unrouted
+        self.mute_keys = dict(zip(MUTE_KEYS, self.players.keys()))
 
     def process_events(self, events=None):
         if events == None:
@@ -310,23 +699,123 @@ class App:
             self.process_event(event)
 
     def process_event(self, event):
+        profiler = self.profiler
+        if profiler:
+            profiler.enable()
+            self._process_event(event)
+            profiler.disable()
+        else:
+            self._process_event(event)
+
+    def _process_event(self, event):
+        if event.type in HOTPLUG_EVENTS:
+            self.joystick_hotplug(event)
+            return
+        if not self.joystick_slots.map_event(event):
+            return
+        if self.latency:
+            self.latency.event_received()
+        if self.recorder:
+            self.recorder.record(event, self.clock())
+        if not self.input_filter(event):
+            return
+        if self.midi_batch:
+            self.midi_batch.mark_input()
         if self.running and (event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE)):
             self.quit()
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_F1:
-                self.control_command({'func': EVENT_CONTROL_MUTE_FUNCTION_NAME, 'input': 'player1'})
-            if event.key == pygame.K_F2:
-                self.control_command({'func': EVENT_CONTROL_MUTE_FUNCTION_NAME, 'input': 'player2'})
-        try:
-            if event.axis != 3:  # The PS3 controler has a touch sensetive pad that constantly spams the logs with axis results
-                log.debug(event)
-        except Exception:
-            log.debug(event)
+        if event.type == pygame.KEYDOWN and event.key in self.mute_keys:
+            self.control_command({'func': EVENT_CONTROL_MUTE_FUNCTION_NAME, 'input': self.mute_keys[event.key]})
+        if event.type == pygame.KEYDOWN and event.key == PROFILE_KEY:
+            self.set_profiling()
+        if self.trace:
+            attribute = controls.EVENT_INPUT_ATTRIBUTE.get(event.type)
+            joy = getattr(event, 'joy', None)
+            self.trace.record(trace_buffer.EVENT, -1 if joy is None else joy, event.type, getattr(event, attribute) if attribute else 0)
+            if event.type == pygame.KEYDOWN and event.key == TRACE_DUMP_KEY:
+                self.trace.dump(self.trace_file)
+
+        source = controls.event_source(event)
+        for player in self.routes.get(source, self.routes_unrouted):
+            if player.update_state(event):
+                player.process_state()
+        if source in self.joystick_slots.reconnecting and any(player.previous_note for player in self.routes.get(source, ())):
+            self.joystick_slots.note_played(source)
+        if self.state_feed:
+            self.state_feed.publish_players(self.state_feed_players)
+        if self.midi_batch:
+            self.midi_batch.flush()
+
+    def publish_state(self):
+        if self.state_feed:
+            self.state_feed.publish_players(self.state_feed_players)
+
+    def joystick_hotplug(self, event):
+        """
+        Rebind a reconnected joystick to its slot, or release everything held on an unplugged one
+        """
+        if event.type == pygame.JOYDEVICEADDED:
+            self.joystick_slots.add(event.device_index)
+            return
+        joy = self.joystick_slots.remove(event.instance_id)
+        if joy is None:
+            return
+        for player in self.routes.get(joy, ()):
+            player.release_all()
+        self.publish_state()
+        if self.midi_batch:
+            self.midi_batch.flush()
+
+    def run_timers(self):
+        if self.state_feed:
+            # Timers can release notes and land pitch bends
+            due = self.scheduler.next_due()
+            self.scheduler.run_due()
+            if due is not None and due <= self.clock():
+                self.publish_state()
+        else:
+            self.scheduler.run_due()
+        if self.midi_batch:
+            self.midi_batch.flush()
+
+    def poll_shards(self):
+        self.scheduler.schedule(self.shard_poll_interval, self.poll_shards)
+        self.shards.poll()
+
+    def report_latency(self):
+        self.scheduler.schedule(self.latency_report_interval, self.report_latency)
+        (self.display_queue or self.display).send_message({
+            'func': EVENT_LATENCY_FUNCTION_NAME,
+            'players': self.latency.summary(),
+        })
+        self.latency.log_summary(logging.DEBUG)
 
-        for player in self.players.values():
-            player.update_state(event)
-        for player in self.players.values():
-            player.process_state()
+    @property
+    def player_metrics(self):
+        return {name: player.metrics for name, player in self.players.items() if hasattr(player, 'metrics')}
+
+    def report_metrics(self):
+        self.scheduler.schedule(self.metrics_report_interval, self.report_metrics)
+        (self.display_queue or self.display).send_message({
+            'func': EVENT_METRICS_FUNCTION_NAME,
+            'players': {name: metrics.snapshot() for name, metrics in self.player_metrics.items()},
+            'filtered': self.input_filter.filtered,
+        })
+
+    def set_profiling(self, profile=None):
+        """
+        Start or stop a cProfile session around process_event (toggles if no state is passed).
+        The stats are written to profile_file when the session stops.
+        """
+        if profile is None:
+            profile = not self.profiler
+        if profile and not self.profiler:
+            log.info('profiling started')
+            self.profiler = cProfile.Profile()
+        elif not profile and self.profiler:
+            profiler, self.profiler = self.profiler, None
+            profiler.disable()
+            profiler.dump_stats(self.profile_file)
+            log.info('profiling stopped - stats written to {0} (python3 -m pstats {0})'.format(self.profile_file))
 
     def control_command(self, data):
         # Not happy here.
@@ -339,20 +828,89 @@ class App:
                 self.control_command(item)
         elif isinstance(data, dict) and data.get('func') == EVENT_CONTROL_MUTE_FUNCTION_NAME:
             self.players[data.get('input')].set_mute_state(data.get('mute'))
+            self.publish_state()
+            if self.midi_batch:
+                self.midi_batch.flush()
+        elif isinstance(data, dict) and data.get('func') == EVENT_CONTROL_PROFILE_FUNCTION_NAME:
+            self.set_profiling(data.get('profile'))
+
+    def set_display_packed(self, packed):
+        """
+        packed: players emit display_codec records (packed by PackedDisplay or converted per client by DisplayHub)
+        """
+        log.info('display events: {0}'.format('records' if packed else 'json'))
+        for player in self.players.values():
+            player.display_packed = packed
+        if self.shards:
+            self.shards.display_packed = packed
 
     def run(self):
         try:
             self.running = True
             while self.running:
                 #self.process_events()
-                self.process_event(self.wait_input())
+                self.run_timers()
+                timeout = self.scheduler.timeout_ms()
+                event = self.wait_input() if timeout is None else self.wait_input(max(1, timeout))  # pygame waits forever with a timeout of 0
+                if event.type != pygame.NOEVENT:
+                    self.process_event(event)
         except KeyboardInterrupt:
             self.running = False
         self.close()
 
+    def replay(self, filename, speed=1.0):
+        """
+        Feed a recorded event log back through the players.
+        speed 1.0 is real time, 0 is as fast as possible.
+        """
+        self.running = True
+        start_timestamp = None
+        start_time = time.monotonic()
+        try:
+            for timestamp, event in read_events(filename):
+                if start_timestamp is None:
+                    start_timestamp = timestamp
+                if speed:
+                    delay = (timestamp - start_timestamp) / 1000000000 / speed - (time.monotonic() - start_time)
+                    if delay > 0:
+                        time.sleep(delay)
+                # Fire the timers that were due between events at the time they were due
+                due = self.scheduler.next_due()
+                while due is not None and due <= timestamp:
+                    self.clock.timestamp = due
+                    self.run_timers()
+                    due = self.scheduler.next_due()
+                self.clock.timestamp = timestamp
+                self.process_event(event)
+                if not self.running:
+                    break
+        except KeyboardInterrupt:
+            pass
+        self.running = False
+        self.close()
+
     def close(self):
+        if self.shards:
+            self.shards.close()
+        if self.trace:
+            self.trace.dump(self.trace_file)
+        if self.recorder:
+            self.recorder.close()
+        self.set_profiling(False)
+        if self.latency:
+            self.latency.log_summary()
+        log_metrics(self.player_metrics)
+        self.joystick_slots.log_summary()
+        log.info('input filter: {0} events filtered ({1})'.format(self.input_filter.total, ', '.join('{0}={1}'.format(*item) for item in self.input_filter.filtered.items())))
+        if self.midi_batch:
+            self.midi_batch.flush()
+            self.midi_batch.log_stats()
         if self.midi_out:
             self.midi_out.close()
+        if self.display_queue:
+            self.display_queue.close()
+        if self.state_feed:
+            self.state_feed.close()
         if self.display:
             self.display.close()
         pygame.midi.quit()
@@ -364,9 +922,9 @@ class App:
 
 # Main -------------------------------------------------------------------------
 
-def get_args():
+def get_args(argv=None):
     """
-    Command line argument handling
+    Command line argument handling (argv defaults to sys.argv)
     """
     import argparse
 
@@ -381,37 +939,78 @@ def get_args():
     #parser_input = argparse.ArgumentParser(prog='input')
     parser_input = parser
 
+    def joy_axis(joy_axis_string):
+        joy, axis = joy_axis_string.split(':')
+        return int(joy), int(axis)
+
     def select_input_profile(input_profile_name):
+        if input_profile_name == 'null_input':
+            return controls.null_input
         try:
-            return getattr(controls, input_profile_name)
-        except AttributeError:
+            return controls.load_profile(input_profile_name)
+        except (IOError, ValueError):
             log.warn('Unable to locate input_profile {0}.'.format(input_profile_name))
             return controls.null_input
 
-    def select_scale(scale_string):
-        return SCALES[scale_string]
-
-    parser_input.add_argument('--input_profile', choices=controls.__all__, help='input1 profile name (defined in controlers.py)', default='keyboard')
-    parser_input.add_argument('--input_profile2', choices=controls.__all__, help='input2 profile name (defined in controlers.py)', default='null_input')
-    parser_input.add_argument('--root_note', action='store', type=parse_note, help='root note (key)', default=DEFAULT_ROOT_NOTE)
-    parser_input.add_argument('--scale', choices=SCALES.keys(), help='scale to use (defined in music.py)', default=DEFAULT_SCALE)
-    parser_input.add_argument('--channel', action='store', type=int, help='Midi channel to output too (player2 is automatically +1)', default=0)
+    parser_input.add_argument('--input_profile', action='store', help='input1 profile name {0} (defined in controls.py) or path to a json profile definition'.format(controls.__all__), default='keyboard')
+    parser_input.add_argument('--input_profile2', action='store', help='input2 profile name (defined in controls.py) or path to a json profile definition', default='null_input')
+    parser_input.add_argument('--input_profiles', action='store', nargs='+', help='Up to 255 player profile names or json paths (replaces --input_profile/--input_profile2). Midi channels are assigned from --channel upwards', default=None)
+    parser_input.add_argument('--drop_axes', action='store', type=joy_axis, nargs='+', metavar='JOY:AXIS', help='Joystick axes to ignore (in addition to the drop_axes of the input profiles) e.g. "0:3 1:3"', default=())
+    parser_input.add_argument('--root_note', action='store', help='root note (key)', default=DEFAULT_ROOT_NOTE)
+    parser_input.add_argument('--scale', action='store', help='scale to use (defined in music.py)', default=DEFAULT_SCALE)
+    parser_input.add_argument('--channel', action='store', type=int, help='Midi channel to output too (each subsequent player is automatically +1)', default=0)
     parser_input.add_argument('--hammer_ons', action='store', type=bool, help='Enable hammer-ons', default=True)
     parser_input.add_argument('--hammer_decay', action='store', type=float, help='Decay with each hammer on', default=DEFAULT_HAMMER_DECAY)
     parser_input.add_argument('--hammer_strum_block_delay', action='store', type=int, help='After hammeron and strum of the same note, Drop the strum from duplicating the note.', default=DEFAULT_HAMMER_STRUM_BLOCK_DELAY)
-    parser_input.add_argument('--note_limit', action='store', type=parse_note, nargs=2, help='Set an upper and lower limit e.g "C2 A6"', default=DEFAULT_NOTE_LIMIT)
+    parser_input.add_argument('--note_limit', action='store', nargs=2, help='Set an upper and lower limit e.g "C2 A6"', default=DEFAULT_NOTE_LIMIT)
+    parser_input.add_argument('--pitch_bend_resolution', action='store', type=int, choices=range(1, 15), metavar='[1-14]', help='Quantise pitch bend to this many bits (14 is full midi resolution)', default=DEFAULT_PITCH_BEND_RESOLUTION)
+    parser_input.add_argument('--pitch_bend_deadband', action='store', type=float, help='Pitch bend values closer than this to center are sent as no bend', default=DEFAULT_PITCH_BEND_DEADBAND)
+    parser_input.add_argument('--pitch_bend_rate', action='store', type=float, help='Max pitch bend messages per second per player (0 is unlimited)', default=DEFAULT_PITCH_BEND_RATE)
+    parser_input.add_argument('--note_sustain', action='store', type=int, help='Release notes after they have rung for this many ms (0 rings until the buttons are released)', default=DEFAULT_NOTE_SUSTAIN)
     parser_input.add_argument('--display_host', action='store', help='ip adress and port for remote TCP display events', default=DEFAULT_DISPLAY_HOST)
+    parser_input.add_argument('--display_hub', action='store_true', help='Serve display clients directly instead of connecting to a display server: tcp (json lines) on the --display_host port and websocket on the next port')
+    parser_input.add_argument('--display_hub_client_buffer', action='store', type=int, help='Bytes a display hub client can fall behind before it is disconnected', default=DEFAULT_DISPLAY_HUB_CLIENT_BUFFER)
+    parser_input.add_argument('--display_queue_size', action='store', type=int, help='Queue display events and send them in batches from a background thread (0 sends synchronously)', default=DEFAULT_QUEUE_SIZE)
+    parser_input.add_argument('--display_drop_policy', choices=DROP_POLICIES, help='Which display events to drop when the display queue is full', default=DROP_POLICIES[0])
+    parser_input.add_argument('--display_format', choices=display_codec.FORMATS, help='json: a json message per display event. packed: compact binary records packed per batch. auto: json, except packed to --display_hub clients that ask for it', default=display_codec.FORMAT_AUTO)
+    parser_input.add_argument('--state_feed', action='store', help='Publish every player\'s buttons, note, playing power, pitch bend and mute to this memory mapped file (e.g. /dev/shm/pentatonic_hero_state) for the DMX renderer (set {0} to the same file)'.format(STATE_FEED_ENVIRONMENT_VARIABLE), default=None)
+    parser_input.add_argument('--latency_report_interval', action='store', type=float, help='Measure input to midi latency and report p50/p99/max every n seconds (0 disables)', default=0)
+    parser_input.add_argument('--metrics_report_interval', action='store', type=float, help='Send per player counters (notes, strums, hammer-ons ...) to the display every n seconds (0 disables). Always logged on close', default=0)
+    parser_input.add_argument('--profile_file', action='store', help='cProfile stats file - profiling is toggled with the Pause key or a {0} control command'.format(EVENT_CONTROL_PROFILE_FUNCTION_NAME), default=DEFAULT_PROFILE_FILE)
+
+    parser.add_argument('--fast_start', action='store_true', help='Only initialise the pygame subsystems and joysticks the input profiles use')
+    parser.add_argument('--headless', action='store_true', help='Run without a window (joystick input only)')
+    parser.add_argument('--runtime', choices=RUNTIMES, help='pygame: blocking wait loop with a display sender thread. asyncio: input polling, timers and display networking on one asyncio loop', default=RUNTIME_PYGAME)
+    parser.add_argument('--poll_interval', action='store', type=int, help='Polling interval in ms for asyncio runtime input and input shard output', default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--input_shards', action='store', type=int, help='Run the players that only read joysticks in up to this many worker processes (0 runs every player in this process)', default=0)
+    parser.add_argument('--shard_ring_size', action='store', type=int, help='Records in the shared memory ring between each input shard and the midi/display writer', default=DEFAULT_SHARD_RING_SIZE)
+    parser.add_argument('--record', action='store', help='Record every input event to this binary log file', default=None)
+    parser.add_argument('--replay', action='store', help='Replay a recorded input event log instead of reading live input', default=None)
+    parser.add_argument('--replay_speed', action='store', type=float, help='Replay speed (1.0 real time, 0 as fast as possible)', default=1.0)
 
     parser.add_argument('--midi_port_name', action='store', help='Output port name to attach too', default=DEFAULT_MIDI_PORT_NAME)
+    parser.add_argument('--midi_output_mode', choices=MIDI_OUTPUT_MODES, help='direct: write each message separately. immediate: write the messages for each input event in one batch. scheduled: batch and timestamp with the input time plus --midi_latency', default=MODE_IMMEDIATE)
+    parser.add_argument('--midi_latency', action='store', type=int, help='Scheduled midi output latency in ms', default=DEFAULT_MIDI_LATENCY)
 
+    parser.add_argument('--trace_size', action='store', type=int, help='Keep a ring buffer of the last n input events and midi messages (0 disables). Dumped on close, SIGUSR1 or the PrintScreen key', default=0)
+    parser.add_argument('--trace_file', action='store', help='File the trace buffer is dumped to', default=trace_buffer.DEFAULT_TRACE_FILE)
     parser.add_argument('--log_level', type=int,  help='log level', default=logging.INFO)
     parser.add_argument('--version', action='version', version=VERSION)
 
-    args = parser.parse_args()
-
-    args.input_profile = select_input_profile(args.input_profile)
-    args.input_profile2 = select_input_profile(args.input_profile2)
-    args.scale = select_scale(args.scale)
+    args = parser.parse_args(argv)
+    if args.input_shards and (args.record or args.replay):
+        # Sharded joysticks are read in the workers, so the main process never sees their events
+        parser.error('--record and --replay cannot be used with --input_shards')
+
+    try:
+        args.input_profile = select_input_profile(args.input_profile)
+        args.input_profile2 = select_input_profile(args.input_profile2)
+        if args.input_profiles:
+            args.input_profiles = [select_input_profile(input_profile) for input_profile in args.input_profiles]
+    except argparse.ArgumentTypeError as ex:
+        parser.error(str(ex))
+    if args.input_profiles and len(args.input_profiles) > display_codec.MAX_INPUT:
+        parser.error('at most {0} --input_profiles are supported'.format(display_codec.MAX_INPUT))
     args.note_limit = NoteLimit(*args.note_limit)
 
     return args
@@ -420,4 +1019,10 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
     logging.basicConfig(level=args.log_level)
-    App(args).run()
+    app = App(args)
+    if args.replay:
+        app.replay(args.replay, args.replay_speed)
+    elif args.runtime == RUNTIME_ASYNCIO:
+        AsyncRuntime(app, args.poll_interval).run()
+    else:
+        app.run()
@@ -11,6 +11,16 @@ var pentatonic_hero = {};
 	var DEFAULT_NUMBER_OF_BUTTONS = 5;
 	var DEFAULT_TRACK_LIMIT = 200;
 	var DEFAULT_TRACK_LENGTH = 400;
+	var DEFAULT_TRACK_CAPACITY = 128;  // note on/off's held per track (power of 2) - the oldest are overwritten
+
+	// Packed display events (see display_codec.py)
+	var PACKED_VERSION = 1;
+	var PACKED_HEADER_SIZE = 11;  // <BHQ version, count, timestamp ms
+	var PACKED_RECORD_SIZE = 8;  // <BBHBhB opcode, input, delta ms, button, value, velocity
+	var PACKED_EVENTS = [null, 'button_down', 'button_up', 'note_on', 'note_off', 'strum', 'pitch'];
+	var PACKED_NO_BUTTON = 0xFF;
+	var PACKED_PITCH_SCALE = 8191;
+	var PACKED_VELOCITY_SCALE = 255;
 
 	// Options -----------------------------------------------------------------
 
@@ -19,6 +29,7 @@ var pentatonic_hero = {};
 		buttons: DEFAULT_NUMBER_OF_BUTTONS,
 		trackLimit: DEFAULT_TRACK_LIMIT,
 		trackLength: DEFAULT_TRACK_LENGTH,
+		trackCapacity: DEFAULT_TRACK_CAPACITY,
 	}, options);
 
 
@@ -30,22 +41,32 @@ var pentatonic_hero = {};
 
 	// Private Class's ---------------------------------------------------------
 
+	// Track data is held in fixed size typed array ring buffers so adding, expiring
+	// and rendering (with renderInto) never allocate
 	var Track = function(options) {
 		this.options = _.extendOwn({
 			trackLimit: DEFAULT_TRACK_LIMIT,
 			trackLength: DEFAULT_TRACK_LENGTH,
+			trackCapacity: DEFAULT_TRACK_CAPACITY,
 		}, options);
+		this.mask = this.options.trackCapacity - 1;
+		this.ticks = new Float64Array(this.options.trackCapacity);
+		this.isDown = new Uint8Array(this.options.trackCapacity);
 		this.reset();
 	};
 
 	Track.prototype = {
 		add: function(tick, isDown) {
-			var lastDatum = _.last(this.data);
-			if (!lastDatum || lastDatum.tick <= tick) {
-				this.data.push({
-					tick: tick,
-					isDown: isDown
-				});
+			if (!this.length || this.ticks[(this.head + this.length - 1) & this.mask] <= tick) {
+				if (this.length > this.mask) {
+					// Full - overwrite the oldest
+					this.head = (this.head + 1) & this.mask;
+					this.length--;
+				}
+				var index = (this.head + this.length) & this.mask;
+				this.ticks[index] = tick;
+				this.isDown[index] = isDown ? 1 : 0;
+				this.length++;
 				this.filterExpired(tick);
 			}
 			//return this;
@@ -53,9 +74,36 @@ var pentatonic_hero = {};
 
 		filterExpired: function(tick) {
 			var tickExpire = (tick - this.options.trackLength);
-			this.data = _.filter(this.data, function(datum) {
-				return datum.tick > tickExpire;
-			}, this);
+			while (this.length && this.ticks[this.head] <= tickExpire) {
+				this.head = (this.head + 1) & this.mask;
+				this.length--;
+			}
+		},
+
+		renderInto: function(tick, starts, stops) {
+			// Write the blocks that render() returns into preallocated arrays (at least trackCapacity long)
+			// Returns the number of blocks
+			var limit = this.options.trackLimit;
+			var count = 0;
+			for (var offset = 0; offset < this.length; offset++) {
+				var index = (this.head + offset) & this.mask;
+				if (this.isDown[index]) {
+					starts[count] = 0;
+					stops[count] = Math.min(tick - this.ticks[index], limit);
+					count++;
+				} else if (count && !starts[count - 1]) {
+					starts[count - 1] = tick - this.ticks[index];
+				}
+			}
+			// Remove blocks entirely over out limit
+			var kept = 0;
+			for (var block = 0; block < count; block++) {
+				if (starts[block] >= limit && stops[block] >= limit) {continue;}
+				starts[kept] = starts[block];
+				stops[kept] = stops[block];
+				kept++;
+			}
+			return kept;
 		},
 	
 		render: function(tick) {
@@ -87,30 +135,16 @@ var pentatonic_hero = {};
 			>>> track = [{tick:750, isDown:true}, {tick:850, isDown:false}, {tick:900, isDown:true}]
 			[{start:150, stop:200}, {start:0, stop:100}]
 			*/
-			var displayData = [];
-			_.each(this.data, function(element, index, list) {
-				var previous = _.last(displayData);
-				if (!element.isDown && previous && !previous.start) {
-					previous.start = tick - element.tick;
-					return;
-				}
-				if (element.isDown) {
-					displayData.push({
-						stop: Math.min(tick - element.tick, this.options.trackLimit),
-						start: 0,
-					});
-					return;
-				}
-			}, this);
-			// Remove element entirely over out limit
-			displayData = _.filter(displayData, function(element){
-				return !(element.start >= this.options.trackLimit && element.stop >= this.options.trackLimit);
-			}, this);
-			return displayData;
+			var starts = new Float64Array(this.options.trackCapacity);
+			var stops = new Float64Array(this.options.trackCapacity);
+			return _.map(_.range(0, this.renderInto(tick, starts, stops)), function(index) {
+				return {start: starts[index], stop: stops[index]};
+			});
 		},
 
 		reset: function() {
-			this.data = [];
+			this.head = 0;
+			this.length = 0;
 		}
 	};
 
@@ -143,6 +177,10 @@ var pentatonic_hero = {};
 			return this.track.render(tick);
 		},
 
+		renderInto: function(tick, starts, stops) {
+			return this.track.renderInto(tick, starts, stops);
+		},
+
 		reset: function() {
 			this.isDown = false;
 			this.track = new Track(this.options);
@@ -161,6 +199,7 @@ var pentatonic_hero = {};
 			numberOfButtons: DEFAULT_NUMBER_OF_BUTTONS,
 			trackLimit: DEFAULT_TRACK_LIMIT,
 			trackLength: DEFAULT_TRACK_LENGTH,
+			trackCapacity: DEFAULT_TRACK_CAPACITY,
 		}, options);
 		this.reset();
 	};
@@ -174,9 +213,9 @@ var pentatonic_hero = {};
 		noteOff: function(tick) {
 			// We only ever play one note at once
 			// A note off event will end all notes but only one of them should be 'active'
-			_.each(this.buttons, function(element, index, list) {
-				element.noteOff(tick);
-			}, this);
+			for (var index = 0; index < this.buttons.length; index++) {
+				this.buttons[index].noteOff(tick);
+			}
 		},
 
 		reset: function() {
@@ -196,10 +235,55 @@ var pentatonic_hero = {};
 	// Init --------------------------------------------------------------------
 
 	_.each(_.range(0, options.inputs), function(element, index, list){
-		inputs.push(new ButtonBoard());
+		inputs.push(new ButtonBoard({
+			numberOfButtons: options.buttons,
+			trackLimit: options.trackLimit,
+			trackLength: options.trackLength,
+			trackCapacity: options.trackCapacity,
+		}));
 	}, this);
 
 
+	// Packed events -----------------------------------------------------------
+
+	function unpackEvents(data) {
+		var binary = atob(data);
+		var bytes = new Uint8Array(binary.length);
+		for (var index = 0; index < binary.length; index++) {
+			bytes[index] = binary.charCodeAt(index);
+		}
+		var view = new DataView(bytes.buffer);
+		if (view.getUint8(0) !== PACKED_VERSION) {
+			console.warn('unsupported packed display event version', view.getUint8(0));
+			return [];
+		}
+		var count = view.getUint16(1, true);
+		var timestamp = view.getUint32(3, true) + (view.getUint32(7, true) * 4294967296);
+		var events = [];
+		for (var record = 0; record < count; record++) {
+			var offset = PACKED_HEADER_SIZE + (record * PACKED_RECORD_SIZE);
+			var opcode = view.getUint8(offset);
+			var button = view.getUint8(offset + 4);
+			var value = view.getInt16(offset + 5, true);
+			timestamp += view.getUint16(offset + 2, true);
+			var event = {
+				event: PACKED_EVENTS[opcode],
+				input: view.getUint8(offset + 1),
+				timestamp: timestamp,
+			};
+			if (button !== PACKED_NO_BUTTON) {event.button = button;}
+			if (event.event === 'pitch') {
+				event.pitch = value / PACKED_PITCH_SCALE;
+			} else {
+				event.value = value;
+			}
+			if (event.event === 'note_on') {event.velocity = view.getUint8(offset + 7) / PACKED_VELOCITY_SCALE;}
+			events.push(event);
+		}
+		return events;
+	}
+
+
 	// Public ------------------------------------------------------------------
 
 	var event_handlers = {
@@ -234,6 +318,17 @@ var pentatonic_hero = {};
 
 	external.event = function(data) {
 		//this.arg = 1515
+		if (_.isArray(data)) {
+			// Batches from the display event queue
+			for (var index = 0; index < data.length; index++) {
+				external.event(data[index]);
+			}
+			return;
+		}
+		if (data.event === 'packed') {
+			external.event(unpackEvents(data.data));
+			return;
+		}
 		data.input = data.input - 1;
 		if (_.has(event_handlers, data.event)) {
 			event_handlers[data.event](data);
@@ -247,6 +342,19 @@ var pentatonic_hero = {};
 		}, this);
 	};
 
+	external.displayInto = function(input, button, starts, stops) {
+		// Allocation free alternative to display() for a single track - see Track.renderInto
+		return inputs[input].buttons[button].renderInto(tick, starts, stops);
+	};
+
+	external.options = options;
+
+	// Send this to pentatonic_hero (running with --display_hub) once connected to receive packed events
+	external.DISPLAY_FORMAT_MESSAGE = {
+		func: 'pentatonic_hero.control.display_format',
+		formats: ['packed', 'json'],
+	};
+
 }(pentatonic_hero, {}));
 
 
@@ -261,14 +369,30 @@ var pentatonic_hero = {};
 		inputs: 2,
 		buttons: 5,
 		trackLimit: 200,
+		renderer: 'dom',  // 'dom' or 'canvas' - can be overridden with a data-renderer attribute on the element
 	}, options);
 
 	var CONTAINER_CLASS = 'pentatonic_hero';
+	var RENDERER_CANVAS = 'canvas';
+
+	// Canvas renderer colors (the dom renderer is styled in pentatonic_hero_visulisation.css)
+	var BUTTON_COLORS = ['green', 'red', 'yellow', 'blue', 'orange'];
+	var BUTTON_TRACK_ON_COLORS = ['#88ff88', '#ff8888', '#888844', '#8888ff', '#888888'];
+	var BUTTON_HEIGHT = 0.05;  // proportion of the canvas height
+	var TRACK_MARGIN = 0.1;  // proportion of the track width left either side of the note blocks
 	
 	var $root;
 	var tick_interval;
 
 	var running = false;
+	var renderer;
+
+	// Canvas renderer state - allocated once in buildCanvas
+	var canvas;
+	var context;
+	var buttonStates;
+	var blockStarts;
+	var blockStops;
 	
 	// Build HTML ----------------
 
@@ -336,6 +460,72 @@ var pentatonic_hero = {};
 		window.requestAnimationFrame(display);
 	}
 	
+	// Canvas render logic ------------
+	// A single canvas redrawn every animation frame from the track ring buffers with no per frame allocations
+
+	function buildCanvas() {
+		$root = $(options.element_id);
+		$root.addClass(CONTAINER_CLASS);
+		$root.empty();
+
+		canvas = document.createElement('canvas');
+		$root.append(canvas);
+		context = canvas.getContext('2d');
+
+		buttonStates = new Uint8Array(options.inputs * options.buttons);
+		blockStarts = new Float64Array(external.options.trackCapacity);
+		blockStops = new Float64Array(external.options.trackCapacity);
+	}
+
+	function displayCanvas() {
+		if (!running) {return;}
+		pentatonic_hero.tick();
+
+		// Match the canvas resolution to its displayed size
+		if (canvas.width !== canvas.clientWidth || canvas.height !== canvas.clientHeight) {
+			canvas.width = canvas.clientWidth;
+			canvas.height = canvas.clientHeight;
+		}
+		var width = canvas.width;
+		var height = canvas.height;
+		var buttonHeight = height * BUTTON_HEIGHT;
+		var trackHeight = height - buttonHeight;
+		var trackWidth = width / (options.inputs * options.buttons);
+		var margin = trackWidth * TRACK_MARGIN;
+		var unit = trackHeight / options.trackLimit;
+
+		context.clearRect(0, 0, width, height);
+		for (var input = 0; input < options.inputs; input++) {
+			for (var button = 0; button < options.buttons; button++) {
+				var x = (input * options.buttons + button) * trackWidth;
+				var color = button % BUTTON_COLORS.length;
+				if (buttonStates[input * options.buttons + button]) {
+					context.fillStyle = BUTTON_TRACK_ON_COLORS[color];
+					context.fillRect(x, 0, trackWidth, trackHeight);
+					context.fillStyle = BUTTON_COLORS[color];
+					context.fillRect(x, trackHeight, trackWidth, buttonHeight);
+				}
+				context.fillStyle = BUTTON_COLORS[color];
+				var count = external.displayInto(input, button, blockStarts, blockStops);
+				for (var block = 0; block < count; block++) {
+					context.fillRect(
+						x + margin,
+						trackHeight - (blockStops[block] * unit),
+						trackWidth - (margin * 2),
+						(blockStops[block] - blockStarts[block]) * unit
+					);
+				}
+			}
+		}
+		window.requestAnimationFrame(displayCanvas);
+	}
+
+	function setButtonState(data, state) {
+		if (data.input < options.inputs && data.button < options.buttons) {
+			buttonStates[data.input * options.buttons + data.button] = state;
+		}
+	}
+
 	function getButton(data) {
 		return $root.find('.input'+data.input + ' .button'+data.button);
 	}
@@ -343,6 +533,12 @@ var pentatonic_hero = {};
 	function start() {
 		if (running) {return;}
 		running = true;
+		renderer = $(options.element_id).data('renderer') || options.renderer;
+		if (renderer === RENDERER_CANVAS) {
+			buildCanvas();
+			window.requestAnimationFrame(displayCanvas);
+			return;
+		}
 		buildHTML();
 		//if (tick_interval != null) {
 		//	clearInterval(tick_interval);
@@ -362,9 +558,17 @@ var pentatonic_hero = {};
 
 	_.extend(external.event_handlers, {
 		button_down: function(data) {
+			if (renderer === RENDERER_CANVAS) {
+				setButtonState(data, 1);
+				return;
+			}
 			getButton(data).addClass('button_on');
 		},
 		button_up: function(data) {
+			if (renderer === RENDERER_CANVAS) {
+				setButtonState(data, 0);
+				return;
+			}
 			getButton(data).removeClass('button_on');
 		},
 	});
@@ -0,0 +1,81 @@
+""" Pentatonic Hero - Heap based timer scheduler on a monotonic integer clock """
+
+# Imports ----------------------------------------------------------------------
+import time
+import heapq
+import itertools
+
+# Constants --------------------------------------------------------------------
+
+clock_ns = time.monotonic_ns
+
+DUE = 0
+CALLBACK = 2
+ARGS = 3
+
+
+# Scheduler --------------------------------------------------------------------
+
+class TimerScheduler(object):
+    """
+    Timers are heap entries of [due_ns, sequence, callback, args].
+    Cancelling clears the callback in place; cancelled entries are discarded when they reach the top of the heap.
+
+    >>> now = [0]
+    >>> scheduler = TimerScheduler(lambda: now[0])
+    >>> fired = []
+    >>> _ = scheduler.schedule(20, fired.append, 'b')
+    >>> _ = scheduler.schedule(10, fired.append, 'a')
+    >>> timer = scheduler.schedule(15, fired.append, 'cancelled')
+    >>> scheduler.cancel(timer)
+    >>> scheduler.next_due()
+    10
+    >>> now[0] = 20
+    >>> scheduler.run_due()
+    >>> fired
+    ['a', 'b']
+    >>> scheduler.next_due() is None
+    True
+    """
+    def __init__(self, clock=clock_ns):
+        self.clock = clock
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def schedule(self, delay_ns, callback, *args):
+        return self.schedule_at(self.clock() + delay_ns, callback, *args)
+
+    def schedule_at(self, due_ns, callback, *args):
+        timer = [due_ns, next(self.sequence), callback, args]
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        if timer:
+            timer[CALLBACK] = None
+
+    def next_due(self):
+        heap = self.heap
+        while heap and heap[0][CALLBACK] is None:
+            heapq.heappop(heap)
+        return heap[0][DUE] if heap else None
+
+    def timeout_ms(self):
+        """
+        Milliseconds until the next timer is due (None if there are no timers)
+        """
+        due = self.next_due()
+        if due is None:
+            return None
+        return max(0, -(-(due - self.clock()) // 1000000))  # round up so we never wake before the timer is due
+
+    def run_due(self):
+        now = self.clock()
+        heap = self.heap
+        while heap and heap[0][DUE] <= now:
+            timer = heapq.heappop(heap)
+            callback = timer[CALLBACK]
+            if callback is not None:
+                timer[CALLBACK] = None
+                callback(*timer[ARGS])
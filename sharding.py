@@ -0,0 +1,327 @@
+""" Pentatonic Hero - Multi process input sharding
+
+Players that only read joysticks can be run in worker processes, each worker
+owning the HeroInputs for a group of joysticks. Workers open their own joysticks
+(SDL delivers joystick events to every process that opens the device, and each
+worker handles the hot-plugging of its own joysticks - see hotplug.py) and write
+the midi messages and display records they produce into a single producer
+single consumer ring buffer in shared memory.
+
+The main process remains the only midi/display writer. It polls the rings from a
+scheduler timer, so a busy player only costs its own worker's time.
+
+Display events without a packed opcode (transpose) and mute commands are rare
+and travel over multiprocessing queues.
+"""
+
+# Imports ----------------------------------------------------------------------
+import os
+import queue
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+
+import pygame
+
+import controls
+import display_codec
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+DEFAULT_RING_SIZE = 4096  # records per worker
+WORKER_WAIT = 50  # ms - longest a worker waits for input before checking for commands
+JOIN_TIMEOUT = 2.0  # seconds
+
+HEAD, TAIL = 0, 1  # ring counters - head is only written by the worker, tail only by the main process
+COUNTERS_SIZE = 16
+RECORD = struct.Struct('<qBBBBBBh')  # timestamp, kind, 5 bytes of data, value
+KIND_MIDI = 1  # status, data1, data2
+KIND_DISPLAY = 2  # opcode, input, button, velocity, (unused), value - a display_codec record
+
+# HeroInput options passed to the workers (the other App options are not needed there or cannot be pickled)
+PLAYER_OPTIONS = (
+    'root_note', 'scale', 'hammer_ons', 'hammer_decay', 'hammer_strum_block_delay', 'note_limit',
+    'pitch_bend_resolution', 'pitch_bend_deadband', 'pitch_bend_rate', 'note_sustain',
+)
+
+
+# Grouping ---------------------------------------------------------------------
+
+def group_players(input_profiles, shards):
+    """
+    Split the indexes of the players that only read joysticks into at most `shards` groups.
+    Players that read the same joystick are kept in the same group.
+    Keyboard players and input processors that do not declare their joysticks stay in the main process.
+
+    >>> from types import SimpleNamespace as Profile
+    >>> keyboard = Profile(sources={'keyboard'}, joysticks=set())
+    >>> group_players([keyboard, Profile(sources={0}, joysticks={0}), Profile(sources={1}, joysticks={1}), Profile(sources={1}, joysticks={1})], 2)
+    [[1], [2, 3]]
+    """
+    clusters = []  # [joysticks, player indexes]
+    for index, input_profile in enumerate(input_profiles):
+        joysticks = getattr(input_profile, 'joysticks', None)
+        if not joysticks or getattr(input_profile, 'sources', None) != joysticks:
+            continue
+        cluster = [set(joysticks), [index]]
+        for other in [other for other in clusters if other[0] & joysticks]:
+            clusters.remove(other)
+            cluster[0] |= other[0]
+            cluster[1] = other[1] + cluster[1]
+        clusters.append(cluster)
+    groups = [[] for _ in range(min(shards, len(clusters)))]
+    for cluster_index, (joysticks, indexes) in enumerate(clusters):
+        groups[cluster_index % len(groups)] += indexes
+    return [sorted(group) for group in groups]
+
+
+# Ring -------------------------------------------------------------------------
+
+class SharedRing(object):
+    """
+    Single producer, single consumer ring of fixed size records in shared memory.
+    The head and tail are free running counters each written by only one side.
+    When the ring is full new records are dropped (and counted) rather than blocking input.
+
+    >>> ring = SharedRing(size=4)
+    >>> for note in range(6):
+    ...     ring.append(0x90, note, 127)
+    >>> ring.dropped
+    2
+    >>> [record[3] for record in ring.read()]
+    [0, 1, 2, 3]
+    >>> ring.read()
+    []
+    >>> ring.close()
+    """
+    def __init__(self, name=None, size=DEFAULT_RING_SIZE):
+        size = 1 << max(0, size - 1).bit_length()  # Round up to a power of 2 so the index can wrap with a mask
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=COUNTERS_SIZE + RECORD.size * size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.size = size
+        self.mask = size - 1
+        self.buffer = self.memory.buf
+        self.counters = self.buffer[:COUNTERS_SIZE].cast('q')
+        if self.owner:
+            self.counters[HEAD] = self.counters[TAIL] = 0
+        self.dropped = 0
+
+    def write(self, kind, a=0, b=0, c=0, d=0, e=0, value=0, timestamp=0):
+        head = self.counters[HEAD]
+        if head - self.counters[TAIL] > self.mask:
+            self.dropped += 1
+            return
+        RECORD.pack_into(self.buffer, COUNTERS_SIZE + (head & self.mask) * RECORD.size, timestamp, kind, a, b, c, d, e, value)
+        self.counters[HEAD] = head + 1  # Published only after the record is written
+
+    def append(self, status, data1, data2):
+        """
+        MidiBatch interface - so MidiBatchOutput can write straight into the ring
+        """
+        self.write(KIND_MIDI, status, data1, data2)
+
+    def read(self):
+        """
+        Every record written since the last read
+        """
+        tail = self.counters[TAIL]
+        head = self.counters[HEAD]
+        records = [
+            RECORD.unpack_from(self.buffer, COUNTERS_SIZE + (counter & self.mask) * RECORD.size)
+            for counter in range(tail, head)
+        ]
+        self.counters[TAIL] = head
+        return records
+
+    def close(self):
+        self.counters.release()
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class ShardDisplay(object):
+    """
+    The display of the players in a worker - packed records go into the ring, anything else onto the message queue
+    """
+    def __init__(self, ring, messages):
+        self.ring = ring
+        self.messages = messages
+
+    def send_message(self, data):
+        if display_codec.is_record(data):
+            opcode, input, timestamp, button, value, velocity = data
+            self.ring.write(KIND_DISPLAY, opcode, input, button, velocity, 0, value, timestamp)
+        else:
+            self.messages.put(data)
+
+
+# Worker -----------------------------------------------------------------------
+
+def run_worker(shard, ring_name, ring_size, players, player_options, drop_axes, messages, commands, stop, log_level):
+    """
+    Worker process entry point.
+    players is a list of (input_identifyer, name, profile name, profile definition, midi channel)
+    """
+    logging.basicConfig(level=log_level)
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # The event queue without a window
+    from scheduler import TimerScheduler
+    from midi_batch import MidiBatchOutput
+    from pentatonic_hero import HeroInput
+    from hotplug import JoystickSlots, HOTPLUG_EVENTS
+
+    pygame.display.init()
+    pygame.joystick.init()
+    joystick_count = pygame.joystick.get_count()
+
+    ring = SharedRing(ring_name, ring_size)
+    display = ShardDisplay(ring, messages)
+    scheduler = TimerScheduler()
+
+    heros = {}
+    routes = {}
+    input_profiles = [controls.InputProfile(profile_name, definition) for input_identifyer, name, profile_name, definition, channel in players]
+    joystick_slots = JoystickSlots(set().union(*(input_profile.joysticks for input_profile in input_profiles)), bind_new=False)  # Every shard sees every new device
+    for joystick_number in sorted(joystick_slots.joysticks):
+        if joystick_number >= joystick_count:
+            log.warning('input shard {0}: joystick {1} is not connected'.format(shard, joystick_number))
+            continue
+        joystick_slots.bind(joystick_number, pygame.joystick.Joystick(joystick_number))
+    for input_profile, (input_identifyer, name, profile_name, definition, channel) in zip(input_profiles, players):
+        player = HeroInput(
+            input_profile,
+            MidiBatchOutput(ring, channel=channel),
+            display=display,
+            scheduler=scheduler,
+            input_identifyer=input_identifyer,
+            **player_options
+        )
+        player.display_packed = True  # Records fit in the ring - the main process converts them to json if needed
+        heros[name] = player
+        for source in input_profile.sources:
+            routes.setdefault(source, []).append(player)
+    input_filter = controls.InputFilter(input_profiles, drop_axes)
+    log.info('input shard {0}: {1}'.format(shard, ', '.join(heros.keys())))
+
+    try:
+        while not stop.is_set():
+            scheduler.run_due()
+            timeout = scheduler.timeout_ms()
+            event = pygame.event.wait(WORKER_WAIT if timeout is None else max(1, min(timeout, WORKER_WAIT)))
+            if event.type in HOTPLUG_EVENTS:
+                if event.type == pygame.JOYDEVICEADDED:
+                    joystick_slots.add(event.device_index)
+                else:
+                    for player in routes.get(joystick_slots.remove(event.instance_id), ()):
+                        player.release_all()
+            elif event.type != pygame.NOEVENT and joystick_slots.map_event(event) and input_filter(event):
+                source = controls.event_source(event)
+                for player in routes.get(source, ()):
+                    if player.update_state(event):
+                        player.process_state()
+                if source in joystick_slots.reconnecting and any(player.previous_note for player in routes.get(source, ())):
+                    joystick_slots.note_played(source)
+            while True:
+                try:
+                    name, mute = commands.get_nowait()
+                except queue.Empty:
+                    break
+                heros[name].set_mute_state(mute)
+    except KeyboardInterrupt:
+        pass
+    # Leave nothing ringing
+    for player in heros.values():
+        player._send_note_off()
+    log.info('input shard {0}: {1} events filtered'.format(shard, input_filter.total))
+    joystick_slots.log_summary()
+    if ring.dropped:
+        log.warning('input shard {0}: {1} records dropped - ring full'.format(shard, ring.dropped))
+    ring.close()
+    pygame.quit()
+
+
+# Main process -----------------------------------------------------------------
+
+class ShardPlayer(object):
+    """
+    Stands in for a HeroInput running in a worker process - mute commands are forwarded to the worker
+    """
+    input_event_processor = controls.null_input  # Routed no events in the main process
+
+    def __init__(self, name, commands):
+        self.name = name
+        self.commands = commands
+        self.display_packed = False
+
+    def set_mute_state(self, mute=None):
+        self.commands.put((self.name, mute))
+
+
+class InputShards(object):
+    """
+    Starts the workers and writes what they produce to the midi batch and display from the main process.
+    groups is a list of player lists as in run_worker.
+    """
+    def __init__(self, groups, player_options, midi_batch, display, drop_axes=(), ring_size=DEFAULT_RING_SIZE, log_level=logging.INFO):
+        context = multiprocessing.get_context('spawn')  # Never fork a process that has SDL initialised
+        self.midi_batch = midi_batch
+        self.display = display
+        self.display_packed = False
+        self.stop = context.Event()
+        self.messages = context.Queue()
+        self.rings = []
+        self.processes = []
+        self.players = {}
+        for shard, players in enumerate(groups):
+            ring = SharedRing(size=ring_size)
+            commands = context.Queue()
+            process = context.Process(
+                target=run_worker,
+                name='input_shard{0}'.format(shard),
+                args=(shard, ring.name, ring.size, players, player_options, tuple(drop_axes), self.messages, commands, self.stop, log_level),
+                daemon=True,
+            )
+            process.start()
+            self.rings.append(ring)
+            self.processes.append(process)
+            for input_identifyer, name, profile_name, definition, channel in players:
+                self.players[name] = ShardPlayer(name, commands)
+
+    def poll(self):
+        """
+        Write everything the workers have produced since the last poll
+        """
+        midi_batch = self.midi_batch
+        display = self.display
+        for ring in self.rings:
+            for timestamp, kind, a, b, c, d, e, value in ring.read():
+                if kind == KIND_MIDI:
+                    midi_batch.append(a, b, c)
+                elif kind == KIND_DISPLAY:
+                    record = display_codec.Record((a, b, timestamp, c, value, d))
+                    display.send_message(record if self.display_packed else display_codec.message(record))
+        while True:
+            try:
+                display.send_message(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        midi_batch.flush()
+
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                log.warning('{0} did not stop - terminating'.format(process.name))
+                process.terminate()
+        self.poll()  # The note offs sent as the workers stopped
+        for ring in self.rings:
+            ring.close()
@@ -0,0 +1,213 @@
+""" Pentatonic Hero - Shared memory player state feed
+
+The latest state of every player in a small fixed layout block in a memory
+mapped file (e.g. under /dev/shm), for readers on the same machine such as the
+DMX lighting renderer that want the current state at their own frame rate
+rather than rebuilding it from display events.
+
+    header  <4sBBxxQ  magic, version, player count, sequence
+    player  <BBBBff   input, button mask, note (0 for none), mute, playing power, pitch bend
+
+The sequence makes the block a seqlock: the writer makes it odd before writing
+and even again after, and a reader retries if it was odd or changed while it
+was reading.
+
+Players the writer does not publish (e.g. those read by input shard workers)
+keep input 0, so readers can fall back to display events for them. A run with
+a different number of players replaces the file rather than resizing it under
+a reader that has it mapped; readers map the new file when it appears.
+
+>>> import os, tempfile
+>>> filename = os.path.join(tempfile.mkdtemp(), 'state')
+>>> feed = StateFeedWriter(filename, 2)
+>>> reader = StateFeedReader(filename)
+>>> feed.write(0, 1, 0b00101, 57, False, 1.0, -0.5)
+>>> feed.publish()
+>>> reader.read()[0]
+PlayerState(input=1, button_mask=5, note=57, mute=False, playing_power=1.0, pitch=-0.5)
+>>> reader.read() is None  # Nothing new
+True
+>>> feed.close()
+>>> reader.read()[0].input  # Cleared on close
+0
+>>> feed = StateFeedWriter(filename, 3)  # More players - a new file
+>>> [state.input for state in reader.read()]
+[0, 0, 0]
+>>> reader.close(); feed.close()
+"""
+
+# Imports ----------------------------------------------------------------------
+import os
+import mmap
+import struct
+import threading
+from collections import namedtuple
+
+# Constants --------------------------------------------------------------------
+
+MAGIC = b'PHST'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxxQ')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+PLAYER = struct.Struct('<BBBBff')
+READ_ATTEMPTS = 8
+
+# The file the DMX renderer reads - set to the --state_feed file
+STATE_FEED_ENVIRONMENT_VARIABLE = 'PENTATONIC_HERO_STATE_FEED'
+
+PlayerState = namedtuple('PlayerState', ('input', 'button_mask', 'note', 'mute', 'playing_power', 'pitch'))
+
+
+def block_size(players):
+    return HEADER.size + PLAYER.size * players
+
+
+# Writer -----------------------------------------------------------------------
+
+class StateFeedWriter(object):
+    """
+    write() player records then publish() them - the sequence is only bumped by publish,
+    so the records written for one input event are seen together
+    """
+    def __init__(self, filename, players):
+        self.players = players
+        self.lock = threading.Lock()  # Control commands (mute) can arrive on another thread
+        self.pending = []
+        self.sequence = _reusable_sequence(filename, players)
+        if self.sequence is None:
+            # A new file swapped in whole - a reader keeps the old one mapped until it notices
+            temporary = '{0}.{1}'.format(filename, os.getpid())
+            with open(temporary, 'wb') as filehandle:
+                filehandle.write(HEADER.pack(MAGIC, VERSION, players, 0) + bytes(PLAYER.size * players))
+            os.replace(temporary, filename)
+            self.sequence = 0
+        # Otherwise reused in place (same size) so a reader that has the block mapped from a previous run keeps working
+        self.file = open(filename, 'r+b')
+        self.memory = mmap.mmap(self.file.fileno(), block_size(players))
+        self.clear()
+
+    def _write(self, index, input, button_mask, note, mute, playing_power, pitch):
+        self.pending.append((HEADER.size + PLAYER.size * index, input, button_mask, note or 0, mute, playing_power, pitch))
+
+    def _publish(self):
+        pending, self.pending = self.pending, []
+        memory = self.memory
+        SEQUENCE.pack_into(memory, SEQUENCE_OFFSET, self.sequence + 1)  # Odd - writing
+        for offset, input, button_mask, note, mute, playing_power, pitch in pending:
+            PLAYER.pack_into(memory, offset, input, button_mask, note, mute, playing_power, pitch)
+        self.sequence += 2
+        SEQUENCE.pack_into(memory, SEQUENCE_OFFSET, self.sequence)
+
+    def write(self, index, input, button_mask, note, mute, playing_power, pitch):
+        with self.lock:
+            self._write(index, input, button_mask, note, mute, playing_power, pitch)
+
+    def publish(self):
+        with self.lock:
+            self._publish()
+
+    def publish_players(self, players):
+        """
+        Write and publish the state of HeroInputs - players[index] is the record index
+        """
+        with self.lock:
+            for index, player in enumerate(players):
+                if hasattr(player, 'button_mask'):  # Players in input shard workers are not published (input stays 0)
+                    self._write(index, player.input_identifyer, player.button_mask, player.previous_note, player.mute, player.playing_power, player.pitch_bend)
+            self._publish()
+
+    def clear(self):
+        with self.lock:
+            for index in range(self.players):
+                self._write(index, 0, 0, 0, False, 0.0, 0.0)
+            self._publish()
+
+    def close(self):
+        """
+        Clear the players so readers do not show a stale state
+        """
+        self.clear()
+        self.memory.close()
+        self.file.close()
+
+
+def _reusable_sequence(filename, players):
+    """
+    The sequence to carry on from if filename is a feed for the same number of players, else None
+    """
+    try:
+        with open(filename, 'rb') as filehandle:
+            header = filehandle.read(HEADER.size)
+            size = os.fstat(filehandle.fileno()).st_size
+    except OSError:
+        return None
+    if len(header) < HEADER.size or size != block_size(players):
+        return None
+    magic, version, _players, sequence = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or _players != players:
+        return None
+    return sequence + (sequence & 1)
+
+
+# Reader -----------------------------------------------------------------------
+
+class StateFeedReader(object):
+    """
+    Reads the player records straight out of the mapped block.
+    read() returns None when nothing has been published since the last read.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.torn = 0
+        self._open()
+
+    def _open(self):
+        self.file = open(self.filename, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.memory = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, players, sequence = HEADER.unpack_from(self.memory, 0) if len(self.memory) >= HEADER.size else (None, None, 0, 0)
+        if magic != MAGIC or version != VERSION or len(self.memory) < block_size(players):
+            self.close()
+            raise ValueError('{0} is not a pentatonic hero state feed'.format(self.filename))
+        self.players = players
+        self.sequence = None
+
+    def _replaced(self):
+        """
+        Map the file again if a writer with a different number of players has replaced it
+        """
+        try:
+            if os.stat(self.filename).st_ino == self.inode:
+                return False
+        except OSError:
+            return False
+        self.close()
+        self._open()
+        return True
+
+    def read(self):
+        memory = self.memory
+        for attempt in range(READ_ATTEMPTS):
+            sequence, = SEQUENCE.unpack_from(memory, SEQUENCE_OFFSET)
+            if sequence == self.sequence:
+                return self.read() if self._replaced() else None
+            if sequence & 1:
+                self.torn += 1
+                continue
+            states = [
+                PlayerState(input, button_mask, note, bool(mute), playing_power, pitch)
+                for input, button_mask, note, mute, playing_power, pitch in (
+                    PLAYER.unpack_from(memory, HEADER.size + PLAYER.size * index) for index in range(self.players)
+                )
+            ]
+            if SEQUENCE.unpack_from(memory, SEQUENCE_OFFSET)[0] == sequence:
+                self.sequence = sequence
+                return states
+            self.torn += 1
+        return None  # The writer kept us out - try again next frame
+
+    def close(self):
+        self.memory.close()
+        self.file.close()
+
@@ -0,0 +1,86 @@
+""" Pentatonic Hero - Low overhead hot path trace ring buffer
+
+Fixed size records (timestamp, kind, player, note, value) are written into
+preallocated arrays. When tracing is disabled the buffer is None and call
+sites skip it with a single truth test.
+"""
+
+# Imports ----------------------------------------------------------------------
+import time
+from array import array
+
+import logging
+log = logging.getLogger(__name__)
+
+# Constants --------------------------------------------------------------------
+
+clock_ns = time.monotonic_ns
+
+DEFAULT_TRACE_FILE = 'pentatonic_hero_trace.txt'
+
+# Record kinds
+EVENT = 1     # player: source joy (-1 none), note: event type, value: button/axis/hat/key
+NOTE_ON = 2   # note: midi note, value: velocity
+NOTE_OFF = 3  # note: midi note
+PITCH = 4     # value: pitch bend
+STRUM = 5     # value: strum direction
+MUTE = 6      # value: mute state
+KIND_NAMES = {
+    EVENT: 'event',
+    NOTE_ON: 'note_on',
+    NOTE_OFF: 'note_off',
+    PITCH: 'pitch',
+    STRUM: 'strum',
+    MUTE: 'mute',
+}
+
+
+# Trace ------------------------------------------------------------------------
+
+class TraceBuffer(object):
+    """
+    >>> trace = TraceBuffer(4)
+    >>> for note in range(6):
+    ...     trace.record(NOTE_ON, 1, note, 1.0, timestamp=note)
+    >>> [record[3] for record in trace.records()]
+    [2, 3, 4, 5]
+    """
+    def __init__(self, size):
+        size = 1 << max(0, size - 1).bit_length()  # Round up to a power of 2 so the index can wrap with a mask
+        self.mask = size - 1
+        self.timestamps = array('q', [0]) * size
+        self.kinds = array('b', [0]) * size
+        self.players = array('b', [0]) * size
+        self.notes = array('l', [0]) * size
+        self.values = array('d', [0]) * size
+        self.index = 0
+        self.count = 0
+
+    @property
+    def length(self):
+        return min(self.count, self.mask + 1)
+
+    def record(self, kind, player=-1, note=0, value=0.0, timestamp=None):
+        index = self.index
+        self.timestamps[index] = clock_ns() if timestamp is None else timestamp
+        self.kinds[index] = kind
+        self.players[index] = player
+        self.notes[index] = note
+        self.values[index] = value
+        self.index = (index + 1) & self.mask
+        self.count += 1
+
+    def records(self):
+        """
+        Oldest to newest (timestamp, kind, player, note, value)
+        """
+        start = self.index if self.count > self.mask else 0
+        for offset in range(self.length):
+            index = (start + offset) & self.mask
+            yield (self.timestamps[index], self.kinds[index], self.players[index], self.notes[index], self.values[index])
+
+    def dump(self, filename=DEFAULT_TRACE_FILE):
+        with open(filename, 'wt') as filehandle:
+            for timestamp, kind, player, note, value in self.records():
+                filehandle.write('{0} {1} {2} {3} {4}\n'.format(timestamp, KIND_NAMES.get(kind, kind), player, note, value))
+        log.info('trace: {0} records written to {1} ({2} recorded)'.format(self.length, filename, self.count))